@@ -0,0 +1,118 @@
+import os, sqlite3, datetime, calendar
+
+# Local store of mergeable APM aggregates, one row per service and UTC day,
+# written by fetch_nr.py
+STORE_PATH = os.getenv("NR_AGGREGATES_DB", os.path.join("state", "apm_aggregates.sqlite"))
+
+# Share of a weekly/monthly window's UTC days that must already be stored for
+# the rollup to be used; the missing days are fetched first (see fetch_nr.py)
+MIN_COVERAGE = float(os.getenv("NR_ROLLUP_MIN_COVERAGE", "0.8"))
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+# Open the store, creating it on first use
+def connect(path=None):
+    path = path or STORE_PATH
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS apm_daily ("
+        "service TEXT NOT NULL, "
+        "day TEXT NOT NULL, "
+        "since_ms INTEGER NOT NULL, "
+        "until_ms INTEGER NOT NULL, "
+        "duration_sum REAL NOT NULL, "
+        "transaction_count REAL NOT NULL, "
+        "error_count REAL NOT NULL, "
+        "PRIMARY KEY (service, day))"
+    )
+    return conn
+
+
+# (since_ms, until_ms) of a UTC day, from its midnight to the next
+def day_window(day):
+    since_ms = calendar.timegm(day.timetuple()) * 1000
+    return since_ms, since_ms + DAY_MS
+
+
+# The UTC days making up a window, or None unless it starts and ends at UTC midnight
+def window_days(since_ms, until_ms):
+    if since_ms % DAY_MS or until_ms % DAY_MS or until_ms <= since_ms:
+        return None
+    first = datetime.datetime.fromtimestamp(since_ms / 1000, datetime.timezone.utc).date()
+    return [first + datetime.timedelta(days=n) for n in range((until_ms - since_ms) // DAY_MS)]
+
+
+# Store one UTC day of partial aggregates per service, replacing an earlier copy of that day
+# partials maps service -> (duration_sum, transaction_count, error_count)
+def save_daily_partials(partials, day, path=None):
+    since_ms, until_ms = day_window(day)
+    with connect(path) as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO apm_daily VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (service, day.isoformat(), since_ms, until_ms, duration_sum, transaction_count, error_count)
+                for service, (duration_sum, transaction_count, error_count) in partials.items()
+            ],
+        )
+    conn.close()
+
+
+# The days, oldest first, for which some service has no stored partials
+def missing_days(services, days, path=None):
+    with connect(path) as conn:
+        stored = set(conn.execute(
+            f"SELECT service, day FROM apm_daily WHERE day IN ({', '.join('?' * len(days))})",
+            [day.isoformat() for day in days],
+        ).fetchall())
+    conn.close()
+    return [day for day in days if any((service, day.isoformat()) not in stored for service in services)]
+
+
+# Turn merged partials into the three report metrics, matching the NRQL definitions:
+# average(duration) * 1000, sum(errors) / count(duration), rate(count(duration), 1 minute)
+def metrics_from_partials(duration_sum, transaction_count, error_count, minutes):
+    if not transaction_count:
+        return {"average_response_time": None, "error_rate": None, "average_throughput": 0}
+    return {
+        "average_response_time": duration_sum / transaction_count * 1000,
+        "error_rate": error_count / transaction_count,
+        "average_throughput": transaction_count / minutes,
+    }
+
+
+# Compute the metrics for every service over [since_ms, until_ms) from stored days
+# The window must start and end at UTC midnight, so its days add up to exactly
+# the window. Returns None when it does not, or a day is missing for some
+# service, so the caller can fall back to querying New Relic
+def rollup(services, since_ms, until_ms, path=None):
+    days = window_days(since_ms, until_ms)
+    if days is None:
+        return None
+    with connect(path) as conn:
+        rows = conn.execute(
+            "SELECT service, duration_sum, transaction_count, error_count "
+            f"FROM apm_daily WHERE day IN ({', '.join('?' * len(days))})",
+            [day.isoformat() for day in days],
+        ).fetchall()
+    conn.close()
+
+    # The table holds a day at most once per service
+    merged = {service: [0, 0, 0, 0] for service in services}
+    for service, duration_sum, transaction_count, error_count in rows:
+        if service in merged:
+            totals = merged[service]
+            totals[0] += duration_sum
+            totals[1] += transaction_count
+            totals[2] += error_count
+            totals[3] += 1
+    if any(totals[3] != len(days) for totals in merged.values()):
+        return None
+
+    minutes = (until_ms - since_ms) / 60000
+    return {
+        service: metrics_from_partials(*totals[:3], minutes)
+        for service, totals in merged.items()
+    }
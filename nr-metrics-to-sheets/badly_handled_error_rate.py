@@ -1,37 +1,14 @@
-import os, requests, yaml, json
 from dotenv import load_dotenv
-import gspread
-import datetime
-
-# Load environment variables from .env file (for local development)
-# In GitHub Actions, these will be provided as environment variables
-load_dotenv()
-
-# gc = gspread.service_account()
-
-# Initialize Google Sheets client using service account credentials
-# Use the path from environment variable or default to service_account.json in current directory
-service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'service_account.json')
-gc = gspread.service_account(filename=service_account_path)
-
-# Get New Relic credentials from environment variables
-# These are set in .env file locally or in GitHub Secrets for Actions
-NR_API_KEY = os.getenv("NEW_RELIC_API_KEY")
-ACCOUNT_ID = int(os.getenv("ACCOUNT_ID"))
-
-# Load services from YAML file
-# This file contains a list of New Relic application names to monitor
-services = yaml.safe_load(open('services.yml'))['services']
-
 
-# New Relic GraphQL API endpoint (EU region)
-url = f"https://api.eu.newrelic.com/graphql"
+# Run on its own, the collector loads the .env file (for local development)
+# before the shared modules read their settings; run.py loads it for all
+# collectors. In GitHub Actions they are provided as environment variables
+if __name__ == "__main__":
+    load_dotenv()
 
-# Set up request headers with authentication
-headers = {
-    "X-Api-Key": NR_API_KEY,
-    "Content-Type": "application/json",  # Required for GraphQL requests
-}
+import sinks
+import nerdgraph
+import datetime
 
 
 def get_month():
@@ -54,32 +31,9 @@ def fetch_badly_handled_error_rate():
 
 
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
+    # Run the month-long Log query in asynchronous mode so a slow run is
+    # polled until done instead of failing with a TIMEOUT
+    results = nerdgraph.run_nrql_async(nrql)
     return results
 
 
@@ -91,7 +45,7 @@ def get_month():
     return datetime.datetime.now().strftime("%B %Y")
 
 # Main execution block
-if __name__ == "__main__":
+def main():
     rows = []
     timestamp = get_current_timestamp()
     total_errors = fetch_badly_handled_error_rate()[0]['totalErrors']
@@ -109,11 +63,12 @@ if __name__ == "__main__":
 
     # Open the Google Sheet and append the data
     print("Updating Google Sheet...")
-    sh = gc.open("Production Reliability Workbook")
-    worksheet = sh.worksheet("Badly Handled ErrorRate")
         
     # Add the logs rows
-    worksheet.append_rows(rows, value_input_option="USER_ENTERED")
+    sinks.append_rows("Badly Handled ErrorRate", rows)
         
     print(f"Successfully updated")
 
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import os, sys, json, time, argparse, datetime, resource, subprocess, tempfile, threading
+import yaml
+import run
+from replay_server import ReplayServer
+
+# End-to-end benchmark of the collectors against replay_server.py and a fake
+# Sheets backend. Every collector runs in its own process, once per number of
+# services, so peak RSS and module state are measured from a clean start.
+
+# Directory holding the collectors, added to the child's import path
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Prefix of the line a child prints its measurements on
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+
+# Stands in for Google Sheets: keeps nothing, counts what would be written
+class FakeSheetsSink:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.appends = 0
+        self.rows = 0
+        self.cells = 0
+        self.bytes = 0
+
+    def append_rows(self, worksheet, rows):
+        with self.lock:
+            self.appends += 1
+            self.rows += len(rows)
+            self.cells += sum(len(row) for row in rows)
+            self.bytes += len(json.dumps(rows, default=str))
+
+
+# Write services.yml and host_guids.yml with `size` made-up entries
+def write_config(directory, size):
+    with open(os.path.join(directory, "services.yml"), "w") as f:
+        yaml.safe_dump({"services": [f"synthetic-service-{i}-prod" for i in range(size)]}, f)
+    with open(os.path.join(directory, "host_guids.yml"), "w") as f:
+        yaml.safe_dump({"hosts": [f"SYNTHETIC-HOST-GUID-{i}" for i in range(size)]}, f)
+
+
+# Run one collector's main() in this process and print its measurements
+def run_child(module_name):
+    sys.path.insert(0, HERE)
+    import importlib
+    import sinks
+    import nerdgraph
+
+    sink = FakeSheetsSink()
+    sinks.use(sink)
+    module = importlib.import_module(module_name)
+
+    error = None
+    start = time.perf_counter()
+    try:
+        module.main()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - start
+
+    flights = nerdgraph.get_client().flights
+    print(RESULT_PREFIX + json.dumps({
+        "wallSeconds": round(wall, 4),
+        "peakRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "sharedQueries": flights.hits,
+        "sheetAppends": sink.appends,
+        "sheetRows": sink.rows,
+        "sheetCells": sink.cells,
+        "sheetBytes": sink.bytes,
+        "error": error,
+    }), flush=True)
+
+
+# Run one collector in a child process against the replay server
+def measure(server, period, name, module_name, size, workdir):
+    env = dict(
+        os.environ,
+        NEW_RELIC_API_KEY="benchmark",
+        ACCOUNT_ID="1",
+        NEW_RELIC_GRAPHQL_URL=server.url,
+        NR_CACHE="0",
+        NR_AGGREGATES_DB=os.path.join(workdir, f"aggregates-{period}-{name}.sqlite"),
+        PYTHONPATH=HERE,
+    )
+    env.pop("NR_RUN_ID", None)
+    env.pop("NR_RECORD_FILE", None)
+
+    server.reset()
+    start = time.perf_counter()
+    child = subprocess.run(
+        [sys.executable, os.path.join(HERE, "benchmark.py"), "--child", module_name],
+        cwd=workdir, env=env, capture_output=True, text=True,
+    )
+    process_seconds = time.perf_counter() - start
+    stats = server.snapshot()
+
+    result = {"error": f"child exited with {child.returncode}: {child.stderr.strip()[-500:]}"}
+    for line in child.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+
+    return {
+        "period": period,
+        "collector": name,
+        "module": module_name,
+        "services": size,
+        "processSeconds": round(process_seconds, 4),
+        "requests": stats["requests"],
+        "queries": stats["queries"],
+        "bytesSent": stats["bytesIn"],
+        "bytesReceived": stats["bytesOut"],
+        "timeouts": stats["timeouts"],
+        "rateLimited": stats["rateLimited"],
+        **result,
+    }
+
+
+# Commit the benchmark ran on, if this is a git checkout
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return (result["period"], result["collector"], result["services"])
+
+
+# Print one line per result, with the change from a previous results file if given
+def print_results(results, baseline=None):
+    previous = {result_key(result): result for result in (baseline or {}).get("results", [])}
+    print(f"{'collector':<28}{'services':>9}{'wall s':>9}{'requests':>10}{'KB recv':>10}{'RSS MB':>8}  change")
+    for result in results:
+        label = f"{result['period']}/{result['collector']}"
+        if result.get("error"):
+            print(f"{label:<28}{result['services']:>9}  failed: {result['error']}")
+            continue
+        change = ""
+        before = previous.get(result_key(result))
+        if before and not before.get("error") and before["wallSeconds"]:
+            change = (f"wall {result['wallSeconds'] / before['wallSeconds'] - 1:+.0%}, "
+                      f"requests {result['requests'] - before['requests']:+d}")
+        print(f"{label:<28}{result['services']:>9}{result['wallSeconds']:>9.2f}{result['requests']:>10}"
+              f"{result['bytesReceived'] / 1024:>10.0f}{result['peakRssKb'] / 1024:>8.0f}  {change}")
+
+
+# Main execution block
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the collectors against a replayed NerdGraph.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--periods", default="daily,weekly,monthly", help="comma-separated periods")
+    parser.add_argument("--collectors", default="all", help="'all' or a comma-separated list, as for run.py")
+    parser.add_argument("--sizes", default="18,100,500,2000", help="comma-separated numbers of services")
+    parser.add_argument("--recording", help="NR_RECORD_FILE recording to replay (synthetic results otherwise)")
+    parser.add_argument("--latency", type=float, default=0.05, help="replayed seconds per query")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="results file (default benchmarks/<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child)
+        raise SystemExit
+
+    periods = [period.strip() for period in args.periods.split(",") if period.strip()]
+    try:
+        sizes = [int(size) for size in args.sizes.split(",")]
+        plan = [(period, name) for period in periods for name in run.parse_collectors(args.collectors, period)]
+    except (ValueError, KeyError) as e:
+        parser.error(str(e))
+
+    server = ReplayServer(
+        recording=args.recording, latency=args.latency, jitter=args.jitter, timeout_rate=args.timeout_rate,
+        rate_limit_rate=args.rate_limit_rate, seed=args.seed,
+    ).start()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            write_config(workdir, size)
+            for period, name in plan:
+                print(f"Running {period}/{name} with {size} services...")
+                results.append(measure(server, period, name, run.COLLECTORS[period][name], size, workdir))
+    server.shutdown()
+
+    commit = current_commit()
+    report = {
+        "commit": commit,
+        "createdAt": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "settings": {
+            "sizes": sizes, "recording": args.recording, "latency": args.latency, "jitter": args.jitter,
+            "timeoutRate": args.timeout_rate, "rateLimitRate": args.rate_limit_rate, "seed": args.seed,
+        },
+        "results": results,
+    }
+
+    output = args.output or os.path.join("benchmarks", f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"Saved results to {output}")
@@ -0,0 +1,25 @@
+import threading
+
+# Lists loaded from the YAML config files, read on first use and kept for the
+# rest of the run, so importing a collector reads nothing from disk
+_lists = {}
+_lock = threading.Lock()
+
+
+def load_list(path, key):
+    with _lock:
+        if path not in _lists:
+            import yaml
+            with open(path) as f:
+                _lists[path] = yaml.safe_load(f)[key]
+        return _lists[path]
+
+
+# New Relic application names to monitor (services.yml)
+def get_services():
+    return load_list("services.yml", "services")
+
+
+# New Relic host GUIDs to monitor (host_guids.yml)
+def get_hosts():
+    return load_list("host_guids.yml", "hosts")
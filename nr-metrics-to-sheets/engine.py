@@ -0,0 +1,34 @@
+import os, asyncio
+import profiling
+
+# Maximum number of calls in flight at the same time, per run_concurrently call
+# Collectors running together each get this many; the NerdGraph client's
+# scheduler and connection pool bound the requests of all of them together
+MAX_CONCURRENCY = int(os.getenv("NR_MAX_CONCURRENCY", "8"))
+
+
+# Run fn(item) for every item concurrently, at most `limit` at a time
+# The blocking calls run in worker threads so they can share the pooled session
+# Results come back in the same order as the items, whatever order they finish in
+async def gather_bounded(fn, items, limit=None):
+    semaphore = asyncio.Semaphore(limit or MAX_CONCURRENCY)
+
+    async def run_one(item):
+        async with semaphore:
+            return await asyncio.to_thread(fn, item)
+
+    return await asyncio.gather(*(run_one(item) for item in items))
+
+
+# Synchronous entry point for collectors: total wall time is roughly the
+# latency of the slowest call instead of the sum of all of them
+def run_concurrently(fn, items, limit=None):
+    items = list(items)
+
+    # Nothing to overlap, skip the event loop
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    # When profiling, the workers keep the caller's phase while it waits on them
+    fn = profiling.inherit(fn)
+    with profiling.phase("wait"):
+        return asyncio.run(gather_bounded(fn, items, limit))
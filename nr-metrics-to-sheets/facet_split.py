@@ -0,0 +1,114 @@
+import os, re, json
+import engine
+
+# Most facets NRQL returns for FACET ... LIMIT MAX
+# A result this long may have been cut short
+FACET_LIMIT = int(os.getenv("NR_FACET_LIMIT", "5000"))
+
+# Windows are not split below this size; a result still saturated there is kept as is
+MIN_SPLIT_WINDOW_MS = int(os.getenv("NR_MIN_SPLIT_WINDOW_SECONDS", "60")) * 1000
+
+# Absolute window as written by time_window.resolve_window
+ABSOLUTE_WINDOW = re.compile(r"\bSINCE\s+(\d+)\s+UNTIL\s+(\d+)\b", re.IGNORECASE)
+
+# How each merged field combines across sub-windows
+MERGE_FUNCTIONS = {
+    "sum": lambda a, b: a + b,
+    "max": max,
+    "min": min,
+}
+
+
+# Replace the absolute window of a query
+def with_window(nrql, since_ms, until_ms):
+    return ABSOLUTE_WINDOW.sub(f"SINCE {since_ms} UNTIL {until_ms}", nrql, count=1)
+
+
+# Merge the facet entries of several sub-windows into one result
+# `merge` maps each aggregate field to "sum", "max" or "min"; e.g. count(*) is
+# summed and max(timestamp) takes the max. Entries come back sorted by the
+# first merged field, descending, like NRQL orders facets.
+def merge_facets(result_lists, merge):
+    merged = {}
+    for entries in result_lists:
+        for entry in entries:
+            key = json.dumps(entry["facet"])
+            if key not in merged:
+                merged[key] = dict(entry)
+                continue
+            target = merged[key]
+            for field, how in merge.items():
+                a, b = target.get(field), entry.get(field)
+                if a is None or b is None:
+                    target[field] = b if a is None else a
+                else:
+                    target[field] = MERGE_FUNCTIONS[how](a, b)
+
+    order_by = next(iter(merge), None)
+    entries = list(merged.values())
+    if order_by:
+        entries.sort(key=lambda entry: entry.get(order_by) or 0, reverse=True)
+    return entries
+
+
+# Run a FACET ... LIMIT MAX query, splitting its window while the result is saturated
+# run_query(nrql) returns the list of facet entries for one query. The query's
+# window must be absolute. The halves of a split run concurrently, and each half
+# is split again until it comes back under the cap, so the merged counts are exact.
+def fetch_facets(run_query, nrql, merge, limit=None, min_window_ms=None):
+    limit = limit or FACET_LIMIT
+    entries = run_query(nrql)
+    if len(entries) < limit:
+        return entries
+    merged = split_facets(run_query, nrql, merge, limit, min_window_ms)
+    return entries if merged is None else merged
+
+
+# Yield the facets of a FACET ... LIMIT MAX query as they stream in, and return
+# the whole result once done
+# stream_query(nrql) yields the entries of one query. Each entry is yielded as
+# soon as it arrives; they are kept too, so the result can be cached, which
+# holds at most `limit` of them. Once the cap is reached the window is split as
+# in fetch_facets and the facets the stream did not reach follow. The facets
+# already yielded carry the whole window's aggregates, as NRQL computes every
+# facet it returns over the full window.
+def iter_facets(stream_query, run_query, nrql, merge, limit=None, min_window_ms=None):
+    limit = limit or FACET_LIMIT
+    entries = []
+    for entry in stream_query(nrql):
+        entries.append(entry)
+        yield entry
+    if len(entries) < limit:
+        return entries
+
+    merged = split_facets(run_query, nrql, merge, limit, min_window_ms)
+    if merged is None:
+        return entries
+    seen = {json.dumps(entry["facet"]) for entry in entries}
+    for entry in merged:
+        if json.dumps(entry["facet"]) not in seen:
+            yield entry
+    return merged
+
+
+# Query both halves of a saturated query's window, split further as needed, and
+# merge them; None when the window cannot be split
+def split_facets(run_query, nrql, merge, limit, min_window_ms=None):
+    min_window_ms = min_window_ms or MIN_SPLIT_WINDOW_MS
+    match = ABSOLUTE_WINDOW.search(nrql)
+    if not match:
+        print(f"Warning: FACET result hit the {limit} cap and the query has no absolute window to split ({nrql})")
+        return None
+    since_ms, until_ms = int(match.group(1)), int(match.group(2))
+    if until_ms - since_ms <= min_window_ms:
+        print(f"Warning: FACET result hit the {limit} cap in a {min_window_ms // 1000}s window, results may be truncated ({nrql})")
+        return None
+
+    # Split the window in two and query both halves
+    middle = (since_ms + until_ms) // 2
+    print(f"FACET result hit the {limit} cap, splitting the window in two...")
+    halves = engine.run_concurrently(
+        lambda window: fetch_facets(run_query, with_window(nrql, *window), merge, limit, min_window_ms),
+        [(since_ms, middle), (middle, until_ms)],
+    )
+    return merge_facets(halves, merge)
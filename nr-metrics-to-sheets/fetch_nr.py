@@ -1,169 +1,180 @@
-import os, requests, yaml
 from dotenv import load_dotenv
-import gspread
-import datetime
-
-# Load environment variables from .env file (for local development)
-# In GitHub Actions, these will be provided as environment variables
-load_dotenv()
-
-# Initialize Google Sheets client using service account credentials
-# This requires a service_account.json file in the project directory
-# In GitHub Actions, this file is created from a base64-encoded secret
-# gc = gspread.service_account()
-
-
-# Use the path from environment variable or default to service_account.json in current directory
-service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'service_account.json')
-gc = gspread.service_account(filename=service_account_path)
-
-# Get New Relic credentials from environment variables
-# These are set in .env file locally or in GitHub Secrets for Actions
-NR_API_KEY = os.getenv("NEW_RELIC_API_KEY")
-ACCOUNT_ID = int(os.getenv("ACCOUNT_ID"))
 
-# Load services from YAML file
-# This file contains a list of New Relic application names to monitor
-services = yaml.safe_load(open('services.yml'))['services']
+# Run on its own, the collector loads the .env file (for local development)
+# before the shared modules read their settings; run.py loads it for all
+# collectors. In GitHub Actions they are provided as environment variables
+if __name__ == "__main__":
+    load_dotenv()
 
+import sinks
+import config
+import nerdgraph
+import aggregates
+import time_window
+import datetime
+import argparse
 
-# New Relic GraphQL API endpoint (EU region)
-# Change to https://api.newrelic.com/graphql for US region
-url = f"https://api.eu.newrelic.com/graphql"
+# Complete UTC days before today the daily run makes sure are stored
+ROLLUP_DAYS = 31
 
-# Set up request headers with authentication
-headers = {
-    "X-Api-Key": NR_API_KEY,
-    "Content-Type": "application/json",  # Required for GraphQL requests
-}
+# Function to fetch all three APM metrics for every service in a single query
+# FACET appName returns one result per service, so this is one round trip
+# no matter how many services are listed in services.yml
+def fetch_apm_metrics(service_names):
+    # Build the IN (...) list of quoted service names
+    app_names = ", ".join(f"'{name}'" for name in service_names)
 
-def fetch_avg_response_time(service_name):
-    # Define NRQL query to get average transaction duration in milliseconds
+    # Define NRQL query to get response time, error rate and throughput per service
     nrql = (
             f"FROM Metric "
-            f"SELECT average(apm.service.transaction.duration) * 1000 AS average_response_time "
-            f"WHERE appName = '{service_name}' "
+            f"SELECT average(apm.service.transaction.duration) * 1000 AS average_response_time, "
+            f"sum(apm.service.error.count['count']) / count(apm.service.transaction.duration) AS error_rate, "
+            f"rate(count(apm.service.transaction.duration), 1 minute) AS average_throughput "
+            f"WHERE appName IN ({app_names}) "
             f"AND transactionType = 'Web' "
             f"SINCE 1 day ago "
-            f"UNTIL now"
+            f"UNTIL now "
+            f"FACET appName "
+            f"LIMIT MAX"
             )
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()  # Raise exception for HTTP errors
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    avg_duration = results[0]["average_response_time"]
-    return avg_duration
-
-def fetch_error_rate(service_name):
-    # Define NRQL query to get error rate
+    # Run the query through the shared NerdGraph client
+    results = nerdgraph.run_nrql(nrql)
+    return {entry["facet"]: entry for entry in results}
+
+# Function to extract the mergeable partial aggregates of each service
+# Services with no traffic get zeros so their day still counts as collected
+def get_partials(metrics, service_names):
+    partials = {}
+    for svc in service_names:
+        svc_metrics = metrics.get(svc, {})
+        partials[svc] = (
+            svc_metrics.get("duration_sum") or 0,
+            svc_metrics.get("transaction_count") or 0,
+            svc_metrics.get("error_count") or 0,
+        )
+    return partials
+
+# Function to fetch the APM metrics of every service for each day from start_day to end_day
+# TIMESERIES 1 day FACET appName returns one bucket per day and service,
+# so any number of days (up to 366) costs a single query
+def fetch_apm_metrics_by_day(service_names, start_day, end_day):
+    app_names = ", ".join(f"'{name}'" for name in service_names)
+
+    # Whole UTC days, from midnight of start_day to midnight after end_day
+    since = datetime.datetime.combine(start_day, datetime.time(), datetime.timezone.utc)
+    until = datetime.datetime.combine(end_day + datetime.timedelta(days=1), datetime.time(), datetime.timezone.utc)
+
+    # Define NRQL query with the same metrics as fetch_apm_metrics plus the
+    # mergeable sums and counts the weekly and monthly rollups are built from
     nrql = (
             f"FROM Metric "
-            f"SELECT sum(apm.service.error.count['count']) / count(apm.service.transaction.duration) AS error_rate "
-            f"WHERE appName = '{service_name}' "
+            f"SELECT average(apm.service.transaction.duration) * 1000 AS average_response_time, "
+            f"sum(apm.service.error.count['count']) / count(apm.service.transaction.duration) AS error_rate, "
+            f"rate(count(apm.service.transaction.duration), 1 minute) AS average_throughput, "
+            f"sum(apm.service.transaction.duration) AS duration_sum, "
+            f"count(apm.service.transaction.duration) AS transaction_count, "
+            f"sum(apm.service.error.count['count']) AS error_count "
+            f"WHERE appName IN ({app_names}) "
             f"AND transactionType = 'Web' "
-            f"SINCE 1 day ago "
-            f"UNTIL now"
+            f"SINCE {time_window.to_epoch_ms(since)} "
+            f"UNTIL {time_window.to_epoch_ms(until)} "
+            f"FACET appName "
+            f"TIMESERIES 1 day "
+            f"LIMIT MAX"
             )
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    error_rate = results[0]["error_rate"]
-    return error_rate
-
-def fetch_throughput(service_name):
-    # Define NRQL query to get throughput (requests per second)
-    nrql = (
-            f"FROM Metric "
-            f"SELECT rate(count(apm.service.transaction.duration), 1 minute) AS average_throughput "
-            f"WHERE appName = '{service_name}' "
-            f"AND transactionType = 'Web' "
-            f"SINCE 1 day ago "
-            f"UNTIL now"
-            )
+    # Run the query through the shared NerdGraph client
+    results = nerdgraph.run_nrql(nrql)
+
+    # Group the buckets by day, then by service name
+    metrics_by_day = {}
+    for entry in results:
+        day = datetime.datetime.fromtimestamp(entry["beginTimeSeconds"], datetime.timezone.utc).date()
+        metrics_by_day.setdefault(day, {})[entry["facet"]] = entry
+    return metrics_by_day
+
+# Function to store the partial aggregates of every UTC day from start_day to end_day
+def store_daily_partials(service_names, start_day, end_day):
+    metrics_by_day = fetch_apm_metrics_by_day(service_names, start_day, end_day)
+    day = start_day
+    while day <= end_day:
+        aggregates.save_daily_partials(get_partials(metrics_by_day.get(day, {}), service_names), day)
+        day += datetime.timedelta(days=1)
+
+# Function to store the complete UTC days of the last month that are missing,
+# up to yesterday, in one query; normally that is just yesterday
+def store_missing_days(service_names, today=None):
+    today = today or time_window.get_run_anchor().date()
+    days = [today - datetime.timedelta(days=n) for n in range(ROLLUP_DAYS, 0, -1)]
+    missing = aggregates.missing_days(service_names, days)
+    if missing:
+        store_daily_partials(service_names, missing[0], missing[-1])
+
+# Function to compute the metrics of a day-aligned window from the stored days
+# Missing days are fetched and stored first, unless more than
+# NR_ROLLUP_MIN_COVERAGE of the window is missing; returns None if the window
+# is not day-aligned or too many days are missing
+def rollup_apm_metrics(service_names, since_ms, until_ms):
+    days = aggregates.window_days(since_ms, until_ms)
+    if days is None:
+        return None
+    missing = aggregates.missing_days(service_names, days)
+    if len(missing) > len(days) * (1 - aggregates.MIN_COVERAGE):
+        return None
+    if missing:
+        print(f"Fetching {len(missing)} missing days of daily aggregates...")
+        store_daily_partials(service_names, missing[0], missing[-1])
+    return aggregates.rollup(service_names, since_ms, until_ms)
+
+# Function to build one report row per service
+def build_rows(timestamp, metrics, service_names):
+    rows = []
+    for svc in service_names:
+        # Services with no traffic in the window are missing from the facets
+        svc_metrics = metrics.get(svc, {})
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    throughput = results[0]["average_throughput"]
-    return throughput
+        # Create a row with all metrics for this service
+        rows.append([
+            timestamp,
+            svc,
+            svc_metrics.get("average_response_time"),
+            svc_metrics.get("error_rate"),
+            svc_metrics.get("average_throughput"),
+        ])
+    return rows
+
+# Function to fill the report for every day from start_day to end_day
+# Each day gets its own date separator row followed by its metrics rows
+def backfill(service_names, start_day, end_day):
+    print(f"Fetching metrics for {len(service_names)} services from {start_day} to {end_day}...")
+    metrics_by_day = fetch_apm_metrics_by_day(service_names, start_day, end_day)
+
+    rows = []
+    day = start_day
+    while day <= end_day:
+        metrics = metrics_by_day.get(day, {})
+
+        # Store the day's partial aggregates so weekly and monthly rollups can use them
+        aggregates.save_daily_partials(get_partials(metrics, service_names), day)
+
+        rows.append(get_date_row(day))
+        rows.extend(build_rows(f"{day} 23:59:59", metrics, service_names))
+        day += datetime.timedelta(days=1)
+
+    # Open the Google Sheet and append all days at once
+    print("Updating Google Sheet...")
+    sinks.append_rows("APM Metrics Report", rows)
+
+    print(f"Successfully backfilled metrics for {len(service_names)} services.")
 
 # Function to get current timestamp
-def timestamp():
+def get_current_timestamp():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-# Function to create a date label row
-def get_date_row():
-    today = datetime.datetime.now().date()
+# Function to create a date label row (for today unless a day is given)
+def get_date_row(today=None):
+    today = today or datetime.datetime.now().date()
     
     # Get day with ordinal suffix (1st, 2nd, 3rd, etc.)
     day = today.day
@@ -178,42 +189,52 @@ def get_date_row():
     # Return the formatted date row
     return [f"▶ {formatted_date} ◀"] + [""] * 6
     
-# Main execution block
-if __name__ == "__main__":
+# Collect today's metrics for every service
+def main():
+    # Load services from YAML file
+    # This file contains a list of New Relic application names to monitor
+    services = config.get_services()
+
     # Get current timestamp for data logging
-    timestamp = timestamp()
+    timestamp = get_current_timestamp()
     
     # Get today's date for the date label row
     date_row = get_date_row()
     
-    # Collect metrics for each service
-    rows = []
-    for svc in services:
-        print(f"Fetching metrics for {svc}...")
-        avg_rt = fetch_avg_response_time(svc)
-        err_rate = fetch_error_rate(svc)
-        throughput = fetch_throughput(svc)
-        
-        # Create a row with all metrics for this service
-        rows.append([
-            timestamp,
-            svc,
-            avg_rt,
-            err_rate,
-            throughput,
-        ])
+    # Collect metrics for all services in one batched query
+    print(f"Fetching metrics for {len(services)} services...")
+    metrics = fetch_apm_metrics(services)
+
+    # Keep the partial aggregates of the complete UTC days so weekly and monthly
+    # reports can be computed locally instead of re-scanning New Relic
+    store_missing_days(services)
+
+    rows = build_rows(timestamp, metrics, services)
     
     # Open the Google Sheet and append the data
     print("Updating Google Sheet...")
-    sh = gc.open("Production Reliability Workbook")
-    worksheet = sh.worksheet("APM Metrics Report")
-    
-    # Add the date separator row
-    worksheet.append_rows([date_row], value_input_option="USER_ENTERED")
     
-    # Add the metrics rows
-    worksheet.append_rows(rows, value_input_option="USER_ENTERED")
+    # Add the date separator row and the metrics rows in one append, so
+    # no other writer's rows can land between them
+    sinks.append_rows("APM Metrics Report", [date_row] + rows)
     
     print(f"Successfully updated metrics for {len(services)} services.")
 
 
+# Main execution block
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect daily APM metrics into Google Sheets.")
+    parser.add_argument(
+        "--backfill", nargs=2, metavar=("START", "END"), type=datetime.date.fromisoformat,
+        help="fill every day from START to END (YYYY-MM-DD, inclusive) instead of today",
+    )
+    args = parser.parse_args()
+
+    if args.backfill:
+        start_day, end_day = args.backfill
+        if start_day > end_day or (end_day - start_day).days >= 366:
+            parser.error("--backfill needs START <= END and at most 366 days")
+        backfill(config.get_services(), start_day, end_day)
+        raise SystemExit
+
+    main()
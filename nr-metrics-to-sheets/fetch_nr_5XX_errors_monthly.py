@@ -1,41 +1,20 @@
-import os, requests, yaml, json
 from dotenv import load_dotenv
-import gspread
-import datetime
-
-# Load environment variables from .env file (for local development)
-# In GitHub Actions, these will be provided as environment variables
-load_dotenv()
-
-# gc = gspread.service_account()
-
-# Initialize Google Sheets client using service account credentials
-# Use the path from environment variable or default to service_account.json in current directory
-service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'service_account.json')
-gc = gspread.service_account(filename=service_account_path)
-
-# Get New Relic credentials from environment variables
-# These are set in .env file locally or in GitHub Secrets for Actions
-NR_API_KEY = os.getenv("NEW_RELIC_API_KEY")
-ACCOUNT_ID = int(os.getenv("ACCOUNT_ID"))
-
-# Load services from YAML file
-# This file contains a list of New Relic application names to monitor
-services = yaml.safe_load(open('services.yml'))['services']
-
 
-# New Relic GraphQL API endpoint (EU region)
-url = f"https://api.eu.newrelic.com/graphql"
+# Run on its own, the collector loads the .env file (for local development)
+# before the shared modules read their settings; run.py loads it for all
+# collectors. In GitHub Actions they are provided as environment variables
+if __name__ == "__main__":
+    load_dotenv()
 
-# Set up request headers with authentication
-headers = {
-    "X-Api-Key": NR_API_KEY,
-    "Content-Type": "application/json",  # Required for GraphQL requests
-}
+import sinks
+import config
+import nerdgraph
+import engine
+import datetime
 
-def fetch_5XX_error(service_name):
-    # Define NRQL query to get error logs
-    nrql = (
+# Define NRQL query to get error logs
+def build_5XX_error_nrql(service_name):
+    return (
             f"FROM Transaction "
             f"SELECT Count(*) AS `count`, max(timestamp) AS `lastSeen` "
             f"WHERE appName = '{service_name}' "
@@ -46,40 +25,18 @@ def fetch_5XX_error(service_name):
             f"LIMIT MAX "
             )
 
+# The response is parsed as it streams in, and if LIMIT MAX is saturated the
+# window is split and the counts merged, so no status code is silently dropped
+def fetch_5XX_error(service_name):
+    nrql = build_5XX_error_nrql(service_name)
+
+    # Run the query through the shared NerdGraph client
+    return nerdgraph.run_nrql_facets(nrql, merge={"count": "sum", "lastSeen": "max"})
+
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    #Parse the response JSON      
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    return results
-
-
-# Fetch total count of errors for a service
-def fetch_5XX_error_count(service_name):
-    # Define NRQL query to get error count
-    nrql = (
+# Define NRQL query to get error count
+def build_5XX_error_count_nrql(service_name):
+    return (
             f"FROM Transaction "
             f"SELECT Count(*) AS `count` "
             f"WHERE appName = '{service_name}' "
@@ -87,34 +44,12 @@ def fetch_5XX_error_count(service_name):
             f"SINCE 1 month ago "
             f"UNTIL now "
             )
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    error_count = results[0]["count"]
-    return error_count
+
+# Function to fetch the total 5XX count for every service
+# The count queries for all services are packed into as few HTTP requests as possible
+def fetch_all_5XX_error_counts(service_names):
+    results = nerdgraph.run_nrql_batch([build_5XX_error_count_nrql(svc) for svc in service_names])
+    return {svc: results[i][0]["count"] for i, svc in enumerate(service_names)}
 
 # Convert lastseen to human-redable string
 def convert_lastseen(lastseen):
@@ -129,50 +64,61 @@ def get_month():
     formatted_month = datetime.datetime.now().strftime("%B %Y")
         # Return the formatted date row
     return [f"▶ {formatted_month} ◀"] + [""] * 6
-# Main execution block
-if __name__ == "__main__":
+
+# Build the rows of one service from its facet entries as they stream in
+def build_5XX_error_rows(svc, total_errors, timestamp):
     rows = []
-    for svc in services:
-        print(f"Fetching 5XX_Errors for {svc}...")
-        errors = fetch_5XX_error(svc)
-        total_errors = fetch_5XX_error_count(svc)
-        timestamp = get_current_timestamp()
-        date_row =  get_month()
-                    
-        # If no errors found, add a row with a message and continue to next service
-        if not errors:
-            rows.append([timestamp,svc, "No errors found", "N/A", "N/A", "N/A", "N/A"])
-            print(f"No errors found for {svc}")
-            continue
-
-        for entry in errors:
-            code_str, statusText = entry["facet"]
-            error_code = "N/A" if code_str is None else int(code_str)
-            count = entry["count"]
-            last_seen = convert_lastseen(entry["lastSeen"])
-            pct_of_total_errors = count / total_errors * 100
-
-            # Create a row with all metrics for this service
-            rows.append([
-                timestamp,
-                svc,
-                statusText,
-                error_code,
-                count,
-                f"{pct_of_total_errors:.2f}%",
-                last_seen
-            ])
+    for entry in fetch_5XX_error(svc):
+        code_str, statusText = entry["facet"]
+        error_code = "N/A" if code_str is None else int(code_str)
+        count = entry["count"]
+        last_seen = convert_lastseen(entry["lastSeen"])
+        pct_of_total_errors = count / total_errors * 100
+
+        # Create a row with all metrics for this service
+        rows.append([
+            timestamp,
+            svc,
+            statusText,
+            error_code,
+            count,
+            f"{pct_of_total_errors:.2f}%",
+            last_seen
+        ])
+
+    # If no errors found, add a row with a message
+    if not rows:
+        rows.append([timestamp,svc, "No errors found", "N/A", "N/A", "N/A", "N/A"])
+        print(f"No errors found for {svc}")
+    return rows
+
+# Main execution block
+def main():
+    # Load services from YAML file
+    # This file contains a list of New Relic application names to monitor
+    services = config.get_services()
+
+    print(f"Fetching 5XX_Errors for {len(services)} services...")
+    all_error_counts = fetch_all_5XX_error_counts(services)
+
+    timestamp = get_current_timestamp()
+    date_row = get_month()
+
+    # Stream the facets of several services at once and keep the rows in service order
+    rows_per_service = engine.run_concurrently(
+        lambda svc: build_5XX_error_rows(svc, all_error_counts[svc], timestamp), services
+    )
+    rows = [row for service_rows in rows_per_service for row in service_rows]
 
     # Open the Google Sheet and append the data
     print("Updating Google Sheet...")
-    sh = gc.open("Production Reliability Workbook")
-    worksheet = sh.worksheet("Monthly 5XX Errors")
         
-    # Add the date separator row
-    worksheet.append_rows([date_row], value_input_option="USER_ENTERED")
-        
-    # Add the logs rows
-    worksheet.append_rows(rows, value_input_option="USER_ENTERED")
+    # Add the date separator row and the logs rows in one append, so
+    # no other writer's rows can land between them
+    sinks.append_rows("Monthly 5XX Errors", [date_row] + rows)
         
     print(f"Successfully updated error logs for {len(services)} services.")
 
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,19 @@
-import os, requests, yaml, json
 from dotenv import load_dotenv
-import gspread
-import datetime
-
-# Load environment variables from .env file (for local development)
-# In GitHub Actions, these will be provided as environment variables
-load_dotenv()
-
-# gc = gspread.service_account()
-
-# Initialize Google Sheets client using service account credentials
-# Use the path from environment variable or default to service_account.json in current directory
-service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'service_account.json')
-gc = gspread.service_account(filename=service_account_path)
-
-# Get New Relic credentials from environment variables
-# These are set in .env file locally or in GitHub Secrets for Actions
-NR_API_KEY = os.getenv("NEW_RELIC_API_KEY")
-ACCOUNT_ID = int(os.getenv("ACCOUNT_ID"))
-
-# Load services from YAML file
-# This file contains a list of New Relic application names to monitor
-services = yaml.safe_load(open('services.yml'))['services']
 
+# Run on its own, the collector loads the .env file (for local development)
+# before the shared modules read their settings; run.py loads it for all
+# collectors. In GitHub Actions they are provided as environment variables
+if __name__ == "__main__":
+    load_dotenv()
 
-# New Relic GraphQL API endpoint (EU region)
-url = f"https://api.eu.newrelic.com/graphql"
-
-# Set up request headers with authentication
-headers = {
-    "X-Api-Key": NR_API_KEY,
-    "Content-Type": "application/json",  # Required for GraphQL requests
-}
+import sinks
+import config
+import nerdgraph
+import datetime
 
-def fetch_error_logs(service_name):
-    # Define NRQL query to get error logs
-    nrql = (
+# Define NRQL query to get error logs
+def build_error_logs_nrql(service_name):
+    return (
             f"FROM Log "
             f"SELECT Count(*) AS `count`, max(timestamp) AS `lastSeen` "
             f"WHERE entity.name = '{service_name}' "
@@ -46,40 +24,9 @@ def fetch_error_logs(service_name):
             f"LIMIT 5 "
             )
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    #Parse the response JSON      
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    return results
-
-# Fetch error logs for checkout-core-prod
-
-# Fetch total count of errors for a service
-def fetch_error_count(service_name):
-    # Define NRQL query to get error count
-    nrql = (
+# Define NRQL query to get error count
+def build_error_count_nrql(service_name):
+    return (
             f"FROM Log "
             f"SELECT Count(*) AS `count` "
             f"WHERE entity.name = '{service_name}' "
@@ -88,34 +35,20 @@ def fetch_error_count(service_name):
             f"UNTIL now "
             )
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    error_count = results[0]["count"]
-    return error_count
+# Function to fetch error logs and total error count for every service
+# Both queries for all services are packed into as few HTTP requests as possible
+def fetch_all_error_logs(service_names):
+    nrqls = []
+    for svc in service_names:
+        nrqls.append(build_error_logs_nrql(svc))
+        nrqls.append(build_error_count_nrql(svc))
+    results = nerdgraph.run_nrql_batch(nrqls)
+
+    # Split the results back per service as (errors, total_errors)
+    return {
+        svc: (results[2 * i], results[2 * i + 1][0]["count"])
+        for i, svc in enumerate(service_names)
+    }
 
 # Convert lastseen to human-redable string
 def convert_lastseen(lastseen):
@@ -159,12 +92,17 @@ def get_weekly_date_range():
     return [f"▶ {date_range} ◀"] + [""] * 6
 
 # Main execution block
-if __name__ == "__main__":
+def main():
+    # Load services from YAML file
+    # This file contains a list of New Relic application names to monitor
+    services = config.get_services()
+
+    print(f"Fetching logs for {len(services)} services...")
+    all_error_logs = fetch_all_error_logs(services)
+
     rows = []
     for svc in services:
-        print(f"Fetching logs for {svc}...")
-        error_logs = fetch_error_logs(svc)
-        total_errors = fetch_error_count(svc)
+        error_logs, total_errors = all_error_logs[svc]
         timestamp = get_current_timestamp()
         date_row = get_weekly_date_range()   
                     
@@ -194,14 +132,13 @@ if __name__ == "__main__":
 
     # Open the Google Sheet and append the data
     print("Updating Google Sheet...")
-    sh = gc.open("Production Reliability Workbook")
-    worksheet = sh.worksheet("Weekly Error Logs")
-        
-    # Add the date separator row
-    worksheet.append_rows([date_row], value_input_option="USER_ENTERED")
         
-    # Add the logs rows
-    worksheet.append_rows(rows, value_input_option="USER_ENTERED")
+    # Add the date separator row and the logs rows in one append, so
+    # no other writer's rows can land between them
+    sinks.append_rows("Weekly Error Logs", [date_row] + rows)
         
     print(f"Successfully updated error logs for {len(services)} services.")
 
+
+if __name__ == "__main__":
+    main()
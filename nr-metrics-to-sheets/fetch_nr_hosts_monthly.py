@@ -1,87 +1,29 @@
-import os, requests, yaml, json
 from dotenv import load_dotenv
-import gspread
-import datetime
-
-# Load environment variables from .env file (for local development)
-# In GitHub Actions, these will be provided as environment variables
-load_dotenv()
-
-# Initialize Google Sheets client using service account credentials
-# This requires a service_account.json file in the project directory
-# In GitHub Actions, this file is created from a base64-encoded secret
-# gc = gspread.service_account()
-
-
-# Use the path from environment variable or default to service_account.json in current directory
-service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'service_account.json')
-gc = gspread.service_account(filename=service_account_path)
-
-# Get New Relic credentials from environment variables
-# These are set in .env file locally or in GitHub Secrets for Actions
-NR_API_KEY = os.getenv("NEW_RELIC_API_KEY")
-ACCOUNT_ID = int(os.getenv("ACCOUNT_ID"))
-
-# Load hosts from YAML file
-# This file contains a list of New Relic host GUIDs to monitor
-hosts = yaml.safe_load(open('host_guids.yml'))['hosts']
 
-# New Relic GraphQL API endpoint (EU region)
-# Change to https://api.newrelic.com/graphql for US region
-url = f"https://api.eu.newrelic.com/graphql"
+# Run on its own, the collector loads the .env file (for local development)
+# before the shared modules read their settings; run.py loads it for all
+# collectors. In GitHub Actions they are provided as environment variables
+if __name__ == "__main__":
+    load_dotenv()
 
-# Set up request headers with authentication
-headers = {
-    "X-Api-Key": NR_API_KEY,
-    "Content-Type": "application/json",  # Required for GraphQL requests
-}
+import sinks
+import config
+import nerdgraph
+import datetime
 
-# Function to fetch average CPU usage for a host
-def fetch_avg_cpu_usage(host_guid):
-    # Define NRQL query to get average CPU usage
-    nrql = (
+# Define NRQL query to get average CPU usage
+def build_avg_cpu_usage_nrql(host_guid):
+    return (
             f"FROM SystemSample "
             f"SELECT average(cpuPercent) AS average_cpu_usage "
             f"WHERE entityGuid = '{host_guid}' "
             f"SINCE 1 month ago "
             f"UNTIL now "
             )
-        
-
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    avg_cpu_usage = results[0]["average_cpu_usage"]
-    return avg_cpu_usage
-    
 
-# Function to fetch average memory usage for a host
-def fetch_avg_memory_usage(host_guid):
-    # Define NRQL query to get average memory usage
-    nrql = (
+# Define NRQL query to get average memory usage
+def build_avg_memory_usage_nrql(host_guid):
+    return (
             f"FROM SystemSample "
             f"SELECT average(memoryUsedPercent) AS average_memory_usage "
             f"WHERE entityGuid = '{host_guid}' "
@@ -89,39 +31,9 @@ def fetch_avg_memory_usage(host_guid):
             f"UNTIL now "
             )
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    avg_memory_usage = results[0]["average_memory_usage"]
-    return avg_memory_usage
-
-# Function to fetch average disk usage for a host
-def fetch_avg_disk_usage(host_guid):
-    # Define NRQL query to get average disk usage
-    nrql = (
+# Define NRQL query to get average disk usage
+def build_avg_disk_usage_nrql(host_guid):
+    return (
             f"FROM SystemSample "
             f"SELECT average(diskUsedPercent) AS average_disk_usage "
             f"WHERE entityGuid = '{host_guid}' "
@@ -129,34 +41,25 @@ def fetch_avg_disk_usage(host_guid):
             f"UNTIL now "
             )
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    avg_disk_usage = results[0]["average_disk_usage"]
-    return avg_disk_usage
+# Function to fetch CPU, memory and disk usage for every host
+# All queries for all hosts are packed into as few HTTP requests as possible
+def fetch_all_host_metrics(host_guids):
+    nrqls = []
+    for host_guid in host_guids:
+        nrqls.append(build_avg_cpu_usage_nrql(host_guid))
+        nrqls.append(build_avg_memory_usage_nrql(host_guid))
+        nrqls.append(build_avg_disk_usage_nrql(host_guid))
+    results = nerdgraph.run_nrql_batch(nrqls)
+
+    # Split the results back per host as (cpu, memory, disk)
+    return {
+        host_guid: (
+            results[3 * i][0]["average_cpu_usage"],
+            results[3 * i + 1][0]["average_memory_usage"],
+            results[3 * i + 2][0]["average_disk_usage"],
+        )
+        for i, host_guid in enumerate(host_guids)
+    }
 
 # Function to get current timestamp
 def get_current_timestamp():
@@ -180,13 +83,17 @@ def convert_host_guid_to_name(host_guid):
         return "checkout-core-prod"
 
 # Main execution block
-if __name__ == "__main__":
+def main():
+    # Load hosts from YAML file
+    # This file contains a list of New Relic host GUIDs to monitor
+    hosts = config.get_hosts()
+
+    print(f"Fetching metrics for {len(hosts)} hosts...")
+    all_host_metrics = fetch_all_host_metrics(hosts)
+
     rows = []
     for host_guid in hosts:
-        print(f"Fetching metrics for {host_guid}...")
-        avg_cpu_usage = fetch_avg_cpu_usage(host_guid)
-        avg_memory_usage = fetch_avg_memory_usage(host_guid)
-        avg_disk_usage = fetch_avg_disk_usage(host_guid)
+        avg_cpu_usage, avg_memory_usage, avg_disk_usage = all_host_metrics[host_guid]
         timestamp = get_current_timestamp()
         date_row = get_month()
         host_name = convert_host_guid_to_name(host_guid) 
@@ -202,13 +109,13 @@ if __name__ == "__main__":
     
     # Open the Google Sheet and append the data
     print("Updating Google Sheet...")
-    sh = gc.open("Production Reliability Workbook")
-    worksheet = sh.worksheet("Montly HOSTS METRICS")
-    
-    # Add the date separator row
-    worksheet.append_rows([date_row], value_input_option="USER_ENTERED")
     
-    # Add the metrics rows
-    worksheet.append_rows(rows, value_input_option="USER_ENTERED")
+    # Add the date separator row and the metrics rows in one append, so
+    # no other writer's rows can land between them
+    sinks.append_rows("Montly HOSTS METRICS", [date_row] + rows)
     
-    print(f"Successfully updated metrics for {len(hosts)} hosts.")
\ No newline at end of file
+    print(f"Successfully updated metrics for {len(hosts)} hosts.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,164 +1,45 @@
-import os, requests, yaml
 from dotenv import load_dotenv
-import gspread
-import datetime
-
-# Load environment variables from .env file (for local development)
-# In GitHub Actions, these will be provided as environment variables
-load_dotenv()
-
-# Initialize Google Sheets client using service account credentials
-# This requires a service_account.json file in the project directory
-# In GitHub Actions, this file is created from a base64-encoded secret
-# gc = gspread.service_account()
-
-
-# Use the path from environment variable or default to service_account.json in current directory
-service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'service_account.json')
-gc = gspread.service_account(filename=service_account_path)
-
-# Get New Relic credentials from environment variables
-# These are set in .env file locally or in GitHub Secrets for Actions
-NR_API_KEY = os.getenv("NEW_RELIC_API_KEY")
-ACCOUNT_ID = int(os.getenv("ACCOUNT_ID"))
-
-# Load services from YAML file
-# This file contains a list of New Relic application names to monitor
-services = yaml.safe_load(open('services.yml'))['services']
-
-
-# New Relic GraphQL API endpoint (EU region)
-# Change to https://api.newrelic.com/graphql for US region
-url = f"https://api.eu.newrelic.com/graphql"
 
-# Set up request headers with authentication
-headers = {
-    "X-Api-Key": NR_API_KEY,
-    "Content-Type": "application/json",  # Required for GraphQL requests
-}
-
-def fetch_avg_response_time(service_name):
-    # Define NRQL query to get average transaction duration in milliseconds
-    nrql = (
-            f"FROM Metric "
-            f"SELECT average(apm.service.transaction.duration) * 1000 AS average_response_time "
-            f"WHERE appName = '{service_name}' "
-            f"AND transactionType = 'Web' "
-            f"SINCE 1 week ago "
-            f"UNTIL now "
-            )
-
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()  # Raise exception for HTTP errors
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    avg_duration = results[0]["average_response_time"]
-    return avg_duration
+# Run on its own, the collector loads the .env file (for local development)
+# before the shared modules read their settings; run.py loads it for all
+# collectors. In GitHub Actions they are provided as environment variables
+if __name__ == "__main__":
+    load_dotenv()
 
-def fetch_error_rate(service_name):
-    # Define NRQL query to get error rate
-    nrql = (
-            f"FROM Metric "
-            f"SELECT sum(apm.service.error.count['count']) / count(apm.service.transaction.duration) AS error_rate "
-            f"WHERE appName = '{service_name}' "
-            f"AND transactionType = 'Web' "
-            f"SINCE 1 week ago "
-            f"UNTIL now "
-            )
+import sinks
+import config
+import nerdgraph
+import fetch_nr
+import time_window
+import datetime
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    error_rate = results[0]["error_rate"]
-    return error_rate
+# Function to fetch all three APM metrics for every service in a single query
+# FACET appName returns one result per service, so this is one round trip
+# no matter how many services are listed in services.yml
+def fetch_apm_metrics(service_names, since_ms, until_ms):
+    # Build the IN (...) list of quoted service names
+    app_names = ", ".join(f"'{name}'" for name in service_names)
 
-def fetch_throughput(service_name):
-    # Define NRQL query to get throughput (requests per second)
+    # Define NRQL query to get response time, error rate and throughput per service
     nrql = (
             f"FROM Metric "
-            f"SELECT rate(count(apm.service.transaction.duration), 1 minute) AS average_throughput "
-            f"WHERE appName = '{service_name}' "
+            f"SELECT average(apm.service.transaction.duration) * 1000 AS average_response_time, "
+            f"sum(apm.service.error.count['count']) / count(apm.service.transaction.duration) AS error_rate, "
+            f"rate(count(apm.service.transaction.duration), 1 minute) AS average_throughput "
+            f"WHERE appName IN ({app_names}) "
             f"AND transactionType = 'Web' "
-            f"SINCE 1 week ago "
-            f"UNTIL now "
+            f"SINCE {since_ms} "
+            f"UNTIL {until_ms} "
+            f"FACET appName "
+            f"LIMIT MAX"
             )
 
-    # Construct the GraphQL query with variables
-    payload = {
-            "query": """
-            query($accountId: Int!, $nrql: Nrql!) {
-                actor {
-                account(id: $accountId) {
-                    nrql(query: $nrql) {
-                    results
-                    }
-                }
-                }
-            }
-            """,
-            "variables": {
-                "accountId": ACCOUNT_ID,
-                "nrql": nrql
-            }
-        }
-    
-    # Make the API request to New Relic
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    
-    # Parse the response JSON
-    data = response.json()
-    results = data["data"]["actor"]["account"]["nrql"]["results"]
-    throughput = results[0]["average_throughput"]
-    return throughput
+    # Run the query through the shared NerdGraph client
+    results = nerdgraph.run_nrql(nrql)
+    return {entry["facet"]: entry for entry in results}
 
 # Function to get current timestamp
-def timestamp():
+def get_current_timestamp():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 # Function to create a date label row like Sunday, May 14th 2025 - Saturday, May 20th 2025
@@ -195,41 +76,51 @@ def get_weekly_date_range():
     return [f"▶ {date_range} ◀"] + [""] * 6
 
 # Main execution block
-if __name__ == "__main__":
+def main():
+    # Load services from YAML file
+    # This file contains a list of New Relic application names to monitor
+    services = config.get_services()
+
     # Get current timestamp for data logging
-    timestamp = timestamp()
+    timestamp = get_current_timestamp()
     
     # Get today's date for the date label row
     date_row = get_weekly_date_range()
     
-    # Collect metrics for each service
+    # Compute the metrics of the week of whole UTC days up to today from the
+    # daily aggregates stored by fetch_nr.py, and only query New Relic for the
+    # whole week when too many days are missing
+    since_ms, until_ms = time_window.day_aligned_window(1, "week")
+    metrics = fetch_nr.rollup_apm_metrics(services, since_ms, until_ms)
+    if metrics is None:
+        print(f"Daily aggregates incomplete, fetching metrics for {len(services)} services...")
+        metrics = fetch_apm_metrics(services, since_ms, until_ms)
+    else:
+        print(f"Computed metrics for {len(services)} services from daily aggregates.")
+
     rows = []
     for svc in services:
-        print(f"Fetching metrics for {svc}...")
-        avg_rt = fetch_avg_response_time(svc)
-        err_rate = fetch_error_rate(svc)
-        throughput = fetch_throughput(svc)
-        
+        # Services with no traffic in the window are missing from the facets
+        svc_metrics = metrics.get(svc, {})
+
         # Create a row with all metrics for this service
         rows.append([
             timestamp,
             svc,
-            avg_rt,
-            err_rate,
-            throughput,
+            svc_metrics.get("average_response_time"),
+            svc_metrics.get("error_rate"),
+            svc_metrics.get("average_throughput"),
         ])
     
     # Open the Google Sheet and append the data
     print("Updating Google Sheet...")
-    sh = gc.open("Production Reliability Workbook")
-    worksheet = sh.worksheet("Weekly APM Metrics")
     
-    # Add the date separator row
-    worksheet.append_rows([date_row], value_input_option="USER_ENTERED")
-    
-    # Add the metrics rows
-    worksheet.append_rows(rows, value_input_option="USER_ENTERED")
+    # Add the date separator row and the metrics rows in one append, so
+    # no other writer's rows can land between them
+    sinks.append_rows("Weekly APM Metrics", [date_row] + rows)
     
     print(f"Successfully updated metrics for {len(services)} services.")
 
 
+if __name__ == "__main__":
+    main()
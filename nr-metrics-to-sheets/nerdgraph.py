@@ -0,0 +1,611 @@
+import os, requests, json, threading, time, atexit, itertools
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+import engine
+import facet_split
+import profiling
+from scheduler import Scheduler, RetryableError
+from nrql_cache import NrqlCache, normalize_nrql
+from singleflight import SingleFlight
+from recording import Recorder
+from query_metrics import QueryMetrics
+from time_window import resolve_window
+from nrql_stream import ResultsStream
+
+# New Relic GraphQL API endpoints per region
+ENDPOINTS = {
+    "EU": "https://api.eu.newrelic.com/graphql",
+    "US": "https://api.newrelic.com/graphql",
+}
+
+# Limits for packing several NRQL queries into one GraphQL document
+# A batch is closed as soon as either limit would be exceeded
+MAX_QUERIES_PER_REQUEST = int(os.getenv("NR_MAX_QUERIES_PER_REQUEST", "25"))
+MAX_DOCUMENT_SIZE = int(os.getenv("NR_MAX_DOCUMENT_SIZE", "50000"))
+
+# GraphQL document for a single NRQL query
+NRQL_QUERY = """
+query($accountId: Int!, $nrql: Nrql!) {
+    actor {
+    account(id: $accountId) {
+        nrql(query: $nrql) {
+        results
+        metadata { eventTypes messages }
+        }
+    }
+    }
+}
+"""
+
+
+# Raised when NerdGraph answers but one of the NRQL queries failed
+class NerdGraphError(Exception):
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+# Raised for rate-limit and TIMEOUT failures, which the scheduler retries
+class NerdGraphRetryableError(NerdGraphError, RetryableError):
+    def __init__(self, message, errors=None, retry_after=None, rate_limited=False):
+        NerdGraphError.__init__(self, message, errors)
+        self.retry_after = retry_after
+        self.rate_limited = rate_limited
+
+
+# HTTP statuses that are retried: rate limited or a transient gateway failure
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+
+
+# Error class of a NerdGraph error, either top-level or under extensions
+def get_error_class(error):
+    return error.get("errorClass") or (error.get("extensions") or {}).get("errorClass") or ""
+
+
+# NerdGraph reports account rate and concurrency limits as errors in the response body
+def is_rate_limit_error(error):
+    message = error.get("message", "").lower()
+    return (
+        get_error_class(error) in ("TOO_MANY_REQUESTS", "RATE_LIMITED")
+        or "rate limit" in message
+        or "too many" in message
+        or "concurrency limit" in message
+    )
+
+
+def is_timeout_error(error):
+    return get_error_class(error) == "TIMEOUT"
+
+
+# The right exception for a failed NRQL query
+def nrql_error(errors, nrql):
+    messages = [error.get("message", "unknown error") for error in errors] or ["no data returned"]
+    message = f"NRQL query failed: {'; '.join(messages)} ({nrql})"
+    if any(is_rate_limit_error(error) for error in errors):
+        return NerdGraphRetryableError(message, errors, rate_limited=True)
+    if any(is_timeout_error(error) for error in errors):
+        return NerdGraphRetryableError(message, errors)
+    return NerdGraphError(message, errors)
+
+
+def raise_nrql_error(errors, nrql):
+    raise nrql_error(errors, nrql)
+
+
+# Seconds from a Retry-After header, if it holds a number
+def parse_retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+# GraphQL document submitting an NRQL query in asynchronous mode
+# If the query outlives `timeout`, NerdGraph returns a queryId to poll instead of failing
+NRQL_ASYNC_QUERY = """
+query($accountId: Int!, $nrql: Nrql!, $timeout: Seconds) {
+    actor {
+    account(id: $accountId) {
+        nrql(query: $nrql, timeout: $timeout, async: true) {
+        results
+        metadata { eventTypes messages }
+        queryProgress {
+            queryId
+            completed
+            retryAfter
+            retryDeadline
+        }
+        }
+    }
+    }
+}
+"""
+
+# GraphQL document polling an asynchronous NRQL query for its results
+NRQL_PROGRESS_QUERY = """
+query($accountId: Int!, $queryId: ID!) {
+    actor {
+    account(id: $accountId) {
+        nrqlQueryProgress(queryId: $queryId) {
+        results
+        queryProgress {
+            queryId
+            completed
+            retryAfter
+            retryDeadline
+        }
+        }
+    }
+    }
+}
+"""
+
+# Bytes read from the socket at a time when streaming results
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Settings for asynchronous NRQL queries (seconds)
+ASYNC_TIMEOUT = int(os.getenv("NR_ASYNC_TIMEOUT", "120"))
+ASYNC_POLL_INTERVAL = float(os.getenv("NR_ASYNC_POLL_INTERVAL", "5"))
+ASYNC_MAX_WAIT = float(os.getenv("NR_ASYNC_MAX_WAIT", "600"))
+# The submit is answered once the query finished or `timeout` ran out, so its
+# read timeout is that long plus this margin instead of NR_READ_TIMEOUT
+ASYNC_READ_MARGIN = float(os.getenv("NR_ASYNC_READ_MARGIN", "30"))
+
+
+# Build the aliased field for one NRQL query, e.g. q0: nrql(query: "...") { results ... }
+# json.dumps produces a valid GraphQL string literal for the query text
+def build_nrql_field(alias, nrql):
+    return f"{alias}: nrql(query: {json.dumps(nrql)}) {{ results metadata {{ eventTypes messages }} }}"
+
+
+# Build one GraphQL document holding every query as an aliased nrql field
+def build_batched_query(nrqls):
+    fields = "\n".join(build_nrql_field(f"q{i}", nrql) for i, nrql in enumerate(nrqls))
+    return (
+        "query($accountId: Int!) {\n"
+        "actor {\n"
+        "account(id: $accountId) {\n"
+        f"{fields}\n"
+        "}\n"
+        "}\n"
+        "}"
+    )
+
+
+# Split the queries into consecutive chunks that respect the batch limits
+def chunk_queries(nrqls, max_queries=None, max_size=None):
+    max_queries = max_queries or MAX_QUERIES_PER_REQUEST
+    max_size = max_size or MAX_DOCUMENT_SIZE
+
+    chunks = []
+    current = []
+    current_size = 0
+    for nrql in nrqls:
+        # Size of the field once aliased, using the widest alias in the chunk
+        field_size = len(build_nrql_field(f"q{max_queries}", nrql))
+        if current and (len(current) >= max_queries or current_size + field_size > max_size):
+            chunks.append(current)
+            current = []
+            current_size = 0
+        current.append(nrql)
+        current_size += field_size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# Return the account object of a NerdGraph response, or {} if it is missing
+def get_account(data):
+    return ((data.get("data") or {}).get("actor") or {}).get("account") or {}
+
+
+# Key under which identical queries share a result within the run
+def flight_key(nrql):
+    return normalize_nrql(nrql)
+
+
+# Client for the NerdGraph API shared by all collectors
+# One pooled keep-alive Session means the TCP+TLS handshake is paid once per run
+# Requests go through a Scheduler that enforces the account's rate limits
+class NerdGraphClient:
+    def __init__(self, api_key, account_id, region="EU", url=None,
+                 connect_timeout=5, read_timeout=60, pool_size=None, scheduler=None, cache=None, recorder=None):
+        self.account_id = account_id
+        self.scheduler = scheduler or Scheduler()
+        self.cache = cache
+        self.recorder = recorder
+        self.metrics = QueryMetrics()
+        self.flights = SingleFlight()
+        self.url = url or ENDPOINTS[region.upper()]
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Set up a pooled session with authentication headers
+        # Every collector of a run shares it, so by default the pool holds as many
+        # connections as the scheduler lets requests run at once (each carries at
+        # least one query). A request beyond that, e.g. while streams are still
+        # being read, waits for a pooled connection instead of opening one that
+        # would be thrown away.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or self.scheduler.slots.limit, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "X-Api-Key": api_key,
+            "Content-Type": "application/json",  # Required for GraphQL requests
+        })
+
+    # Build a client from the environment (.env locally, GitHub Secrets in Actions)
+    @classmethod
+    def from_env(cls):
+        return cls(
+            api_key=os.getenv("NEW_RELIC_API_KEY"),
+            account_id=int(os.getenv("ACCOUNT_ID")),
+            region=os.getenv("NEW_RELIC_REGION", "EU"),
+            url=os.getenv("NEW_RELIC_GRAPHQL_URL"),
+            connect_timeout=float(os.getenv("NR_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(os.getenv("NR_READ_TIMEOUT", "60")),
+            pool_size=int(os.getenv("NR_POOL_SIZE", "0")) or None,
+            scheduler=Scheduler.from_env(),
+            cache=NrqlCache.from_env(),
+            recorder=Recorder.from_env(),
+        )
+
+    # Send a GraphQL document and return the parsed response JSON
+    def execute(self, query, variables=None, read_timeout=None):
+        return self.post(query, variables, read_timeout=read_timeout).json()
+
+    # Send a GraphQL document and return the HTTP response
+    # With stream=True the body is left unread for incremental parsing
+    # A read_timeout given by the caller replaces the session's, and running
+    # past it is not retried: the caller already waited as long as the query may take
+    def post(self, query, variables=None, stream=False, read_timeout=None):
+        variables = dict(variables or {})
+        variables.setdefault("accountId", self.account_id)
+        payload = {"query": query, "variables": variables}
+        timeout = self.timeout if read_timeout is None else (self.timeout[0], read_timeout)
+
+        # Make the API request to New Relic
+        try:
+            response = self.session.post(self.url, json=payload, timeout=timeout, stream=stream)
+        except requests.exceptions.ReadTimeout as e:
+            if read_timeout is not None:
+                raise NerdGraphError(f"no answer within {read_timeout} seconds: {e}")
+            raise NerdGraphRetryableError(f"request failed: {e}")
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            raise NerdGraphRetryableError(f"request failed: {e}")
+        if response.status_code in RETRYABLE_STATUSES:
+            raise NerdGraphRetryableError(
+                f"HTTP {response.status_code}",
+                retry_after=parse_retry_after(response),
+                rate_limited=response.status_code == 429,
+            )
+        response.raise_for_status()
+        if not stream:
+            self.metrics.add_bytes(len(response.content))
+        return response
+
+    # Send one NRQL query and return its results list
+    def nrql_request(self, nrql):
+        with self.metrics.request("nrql", [nrql]):
+            data = self.execute(NRQL_QUERY, {"nrql": nrql})
+            field = get_account(data).get("nrql")
+            if field is None:
+                raise_nrql_error(data.get("errors") or [], nrql)
+            self.metrics.answered(nrql, field["results"], field.get("metadata"))
+            return field["results"]
+
+    # Look up already fetched results for a query whose window is absolute
+    def cached(self, nrql):
+        if self.cache is None:
+            return None
+        results = self.cache.get(self.account_id, nrql)
+        if results is not None:
+            self.record(nrql, results)
+        return results
+
+    def store(self, nrql, results):
+        if self.cache is not None:
+            self.cache.put(self.account_id, nrql, results)
+        self.record(nrql, results)
+
+    # With NR_RECORD_FILE set, keep every answered query for replay_server.py
+    def record(self, nrql, results):
+        if self.recorder is not None:
+            self.recorder.record(nrql, results)
+
+    # Send a request under the scheduler; counted as the fetch phase when profiling
+    def call(self, fn, *args, cost=1):
+        with profiling.phase("fetch"):
+            return self.scheduler.call(fn, *args, cost=cost)
+
+    # Run one NRQL query under the scheduler, retrying rate limits and timeouts
+    # Relative windows are pinned to the run anchor so the result can be cached
+    # Identical queries within the run share one request and one result
+    def nrql(self, nrql):
+        nrql = resolve_window(nrql)
+        return self.flights.do(flight_key(nrql), self.fetch_nrql, nrql)
+
+    def fetch_nrql(self, nrql):
+        results = self.cached(nrql)
+        if results is None:
+            results = self.call(self.nrql_request, nrql)
+            self.store(nrql, results)
+        return results
+
+    # Run one NRQL query and yield its result entries one at a time as the
+    # response body arrives, so large FACET ... LIMIT MAX results never sit in
+    # memory as a whole. Streamed results are not written to the cache.
+    def nrql_iter(self, nrql):
+        nrql = resolve_window(nrql)
+        results = self.cached(nrql)
+        if results is not None:
+            yield from results
+            return
+
+        # While recording, a copy of the entries is kept until the stream ends
+        recorded = [] if self.recorder is not None else None
+        for entry in self.stream_nrql(nrql):
+            if recorded is not None:
+                recorded.append(entry)
+            yield entry
+        if recorded is not None:
+            self.record(nrql, recorded)
+
+    # Yield the result entries of one NRQL query as they arrive, bypassing the cache
+    def stream_nrql(self, nrql):
+        response, first, entries, request = self.call(self.open_nrql_stream, nrql)
+        count = 0
+        resumed = time.perf_counter()
+        with response:
+            if first is not None:
+                for _, entry in itertools.chain([first], entries):
+                    count += 1
+                    yield entry
+        self.metrics.extend(request, time.perf_counter() - resumed)
+        self.metrics.answered(nrql, count)
+
+    # Run a FACET ... LIMIT MAX query and yield all its facets as they stream in
+    # If the result hits the facet cap, the window is split and the sub-window
+    # results merged as described by `merge` (see facet_split.iter_facets).
+    # The whole result is cached and shared with identical queries of the run
+    # like nrql() results; callers arriving while it streams get it once it ends.
+    def nrql_facets(self, nrql, merge):
+        nrql = resolve_window(nrql)
+        key = flight_key(nrql)
+        future, owner = self.flights.claim(key)
+        if not owner:
+            yield from future.result()
+            return
+        try:
+            results = self.cached(nrql)
+            if results is None:
+                results = yield from facet_split.iter_facets(self.stream_nrql, self.nrql, nrql, merge)
+                self.store(nrql, results)
+            else:
+                yield from results
+        except BaseException as e:
+            self.flights.fail(key, future, e)
+            raise
+        self.flights.resolve(future, results)
+
+    # Open a streamed NRQL response and read up to its first result entry, so a
+    # response carrying errors instead of results is raised (and retried) here
+    # The returned request record keeps counting bytes as the rest is read
+    def open_nrql_stream(self, nrql):
+        with self.metrics.request("stream", [nrql]) as request:
+            response = self.post(NRQL_QUERY, {"nrql": nrql}, stream=True)
+
+            def chunks():
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    request.bytes += len(chunk)
+                    yield chunk
+
+            stream = ResultsStream(chunks())
+            entries = iter(stream)
+            first = next(entries, None)
+            if first is None and not stream.found_results:
+                response.close()
+                raise_nrql_error(stream.errors, nrql)
+        return response, first, entries, request
+
+    # Submit one NRQL query in asynchronous mode and return its nrql field
+    def nrql_async_request(self, nrql, timeout):
+        with self.metrics.request("async", [nrql]):
+            data = self.execute(NRQL_ASYNC_QUERY, {"nrql": nrql, "timeout": timeout},
+                                read_timeout=timeout + ASYNC_READ_MARGIN)
+            field = get_account(data).get("nrql")
+            if field is None:
+                raise_nrql_error(data.get("errors") or [], nrql)
+            self.metrics.answered(nrql, field.get("results"), field.get("metadata"))
+            return field
+
+    # Ask NerdGraph how an asynchronous query is doing and return its progress field
+    def nrql_progress_request(self, query_id, nrql):
+        with self.metrics.request("progress", [nrql]):
+            data = self.execute(NRQL_PROGRESS_QUERY, {"queryId": query_id})
+            field = get_account(data).get("nrqlQueryProgress")
+            if field is None:
+                raise_nrql_error(data.get("errors") or [], nrql)
+            self.metrics.answered(nrql, field.get("results"))
+            return field
+
+    # Run a heavy NRQL query in asynchronous mode
+    # The query is submitted once and then polled, so a slow query is never
+    # restarted from zero; only the submit and each poll are retried on failure
+    def nrql_async(self, nrql, timeout=None, poll_interval=None, max_wait=None):
+        nrql = resolve_window(nrql)
+        return self.flights.do(flight_key(nrql), self.fetch_nrql_async, nrql, timeout, poll_interval, max_wait)
+
+    def fetch_nrql_async(self, nrql, timeout=None, poll_interval=None, max_wait=None):
+        results = self.cached(nrql)
+        if results is None:
+            with profiling.phase("fetch"):
+                results = self.poll_async(nrql, timeout, poll_interval, max_wait)
+            self.store(nrql, results)
+        return results
+
+    def poll_async(self, nrql, timeout=None, poll_interval=None, max_wait=None):
+        timeout = timeout or ASYNC_TIMEOUT
+        poll_interval = poll_interval or ASYNC_POLL_INTERVAL
+        deadline = time.monotonic() + (max_wait or ASYNC_MAX_WAIT)
+
+        field = self.call(self.nrql_async_request, nrql, timeout)
+        while True:
+            progress = field.get("queryProgress")
+
+            # No progress means the query finished within the timeout
+            if not progress or progress.get("completed"):
+                return field["results"]
+            if time.monotonic() > deadline:
+                raise NerdGraphError(f"NRQL query still running after {max_wait or ASYNC_MAX_WAIT} seconds ({nrql})")
+
+            # NerdGraph says how long to wait before polling again
+            wait = progress.get("retryAfter") or poll_interval
+            print(f"NerdGraph: query {progress['queryId']} still running, checking again in {wait} seconds...")
+            time.sleep(wait)
+            field = self.call(self.nrql_progress_request, progress["queryId"], nrql)
+
+    # Send one batched document and return the results list for each query, in order
+    # A query that failed on its own gets its exception in place of results, so
+    # it does not throw away the results of the others; only a document that
+    # failed as a whole raises
+    def nrql_batch_request(self, nrqls):
+        with self.metrics.request("batch", nrqls):
+            data = self.execute(build_batched_query(nrqls))
+            account = get_account(data)
+            if not account:
+                raise_nrql_error(data.get("errors") or [], f"{len(nrqls)} batched queries")
+
+            # A failed query comes back as a null alias plus an error whose path names it
+            errors_by_alias = {}
+            for error in data.get("errors") or []:
+                path = error.get("path") or []
+                alias = path[2] if len(path) > 2 else None
+                errors_by_alias.setdefault(alias, []).append(error)
+
+            results = []
+            for i, nrql in enumerate(nrqls):
+                field = account.get(f"q{i}")
+                if field is None:
+                    results.append(nrql_error(errors_by_alias.get(f"q{i}") or errors_by_alias.get(None) or [], nrql))
+                    continue
+                self.metrics.answered(nrql, field["results"], field.get("metadata"))
+                results.append(field["results"])
+            return results
+
+    # Send one batched document under the scheduler; it costs one token per query
+    # Queries that failed with a rate limit or TIMEOUT are sent again one at a
+    # time under the scheduler's retries, instead of retrying the whole batch
+    # Returns results lists, or the exception of a query that kept failing
+    def scheduled_batch_request(self, nrqls):
+        results = self.call(self.nrql_batch_request, nrqls, cost=len(nrqls))
+        failed = [i for i, result in enumerate(results) if isinstance(result, RetryableError)]
+        if failed:
+            print(f"NerdGraph: {len(failed)} of {len(nrqls)} batched queries failed, sending them again one by one...")
+            for i, result in zip(failed, engine.run_concurrently(self.retry_request, [nrqls[i] for i in failed])):
+                results[i] = result
+        return results
+
+    # Run one NRQL query under the scheduler, returning its exception if it keeps failing
+    def retry_request(self, nrql):
+        try:
+            return self.call(self.nrql_request, nrql)
+        except NerdGraphError as e:
+            return e
+
+    # Run any number of NRQL queries using as few HTTP requests as the limits allow
+    # The requests run concurrently, bounded by NR_MAX_CONCURRENCY
+    # Returns the results lists in the same order as the queries were given
+    # Queries already in the cache are answered locally and never sent
+    # Queries already in flight or done in this run are not sent again
+    def nrql_batch(self, nrqls, max_queries=None, max_size=None):
+        nrqls = [resolve_window(nrql) for nrql in nrqls]
+        claims = [self.flights.claim(flight_key(nrql)) for nrql in nrqls]
+        owned = [(nrql, future) for nrql, (future, owner) in zip(nrqls, claims) if owner]
+
+        try:
+            fetched = self.fetch_batch([nrql for nrql, _ in owned], max_queries, max_size)
+        except BaseException as e:
+            for nrql, future in owned:
+                self.flights.fail(flight_key(nrql), future, e)
+            raise
+        # Every query that succeeded is shared before a failed one is raised
+        for (nrql, future), result in zip(owned, fetched):
+            if isinstance(result, NerdGraphError):
+                self.flights.fail(flight_key(nrql), future, result)
+            else:
+                self.flights.resolve(future, result)
+        return [future.result() for future, _ in claims]
+
+    # Results lists of the queries in order, or the exception of a query that failed
+    def fetch_batch(self, nrqls, max_queries=None, max_size=None):
+        results = [self.cached(nrql) for nrql in nrqls]
+        missing = [nrql for nrql, cached in zip(nrqls, results) if cached is None]
+
+        # Send the cache misses and slot their results back in order
+        fetched = []
+        chunks = chunk_queries(missing, max_queries, max_size)
+        for chunk_results in engine.run_concurrently(self.scheduled_batch_request, chunks):
+            fetched.extend(chunk_results)
+        for nrql, result in zip(missing, fetched):
+            if not isinstance(result, NerdGraphError):
+                self.store(nrql, result)
+
+        fetched = iter(fetched)
+        return [next(fetched) if cached is None else cached for cached in results]
+
+
+# The client is created on first use and reused for the rest of the run
+# The lock keeps concurrent workers from building two clients
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            # Imported by another script, the credentials may still be in .env
+            load_dotenv()
+            _client = NerdGraphClient.from_env()
+            atexit.register(report_run)
+    return _client
+
+
+# At the end of the run, print how many queries were shared with an identical
+# earlier one and write the per-query metrics (see query_metrics.py)
+def report_run():
+    if _client is None:
+        return
+    if _client.flights.misses:
+        print(f"NerdGraph: {_client.flights.summary()}")
+    directory = _client.metrics.write()
+    if directory:
+        summary = _client.metrics.summary()
+        print(f"NerdGraph: {summary['requests']} requests, {summary['seconds']:.1f}s, "
+              f"{summary['bytes'] / 1024:.0f} KB; metrics written to {directory}/")
+
+
+# Run one NRQL query with the shared client
+def run_nrql(nrql):
+    return get_client().nrql(nrql)
+
+
+# Run many NRQL queries with the shared client, batching them into few requests
+def run_nrql_batch(nrqls, max_queries=None, max_size=None):
+    return get_client().nrql_batch(nrqls, max_queries, max_size)
+
+
+# Run one heavy NRQL query in asynchronous mode with the shared client
+def run_nrql_async(nrql, timeout=None):
+    return get_client().nrql_async(nrql, timeout)
+
+
+# Run one NRQL query with the shared client, yielding result entries as they arrive
+def iter_nrql(nrql):
+    return get_client().nrql_iter(nrql)
+
+
+# Run a FACET ... LIMIT MAX query with the shared client, yielding facets as
+# they arrive and splitting saturated windows
+def run_nrql_facets(nrql, merge):
+    return get_client().nrql_facets(nrql, merge)
@@ -0,0 +1,102 @@
+import os, re, json, time, hashlib, threading, tempfile
+
+
+# Collapse whitespace so formatting differences do not change the key
+def normalize_nrql(nrql):
+    return re.sub(r"\s+", " ", nrql).strip()
+
+
+# Content address of a query: its account and normalized NRQL
+# Relative windows must be resolved to absolute SINCE/UNTIL before this
+def cache_key(account_id, nrql):
+    raw = json.dumps({"account": account_id, "nrql": normalize_nrql(nrql)}, sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+# On-disk cache of NerdGraph results, one JSON file per query
+# Entries expire after `ttl` seconds and the least recently used files are
+# evicted once the directory grows past `max_bytes`
+class NrqlCache:
+    def __init__(self, directory, ttl=86400, max_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # Build a cache from the environment, or None when NR_CACHE=0
+    @classmethod
+    def from_env(cls):
+        if os.getenv("NR_CACHE", "1") == "0":
+            return None
+        return cls(
+            directory=os.getenv("NR_CACHE_DIR", ".nrql_cache"),
+            ttl=float(os.getenv("NR_CACHE_TTL", "86400")),
+            max_bytes=int(os.getenv("NR_CACHE_MAX_BYTES", str(50 * 1024 * 1024))),
+        )
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    # Return the cached results for a query, or None on a miss
+    def get(self, account_id, nrql):
+        path = self.path(cache_key(account_id, nrql))
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Drop expired entries
+        if time.time() - entry["storedAt"] > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        # Touch the file so eviction sees it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["results"]
+
+    # Store the results for a query, then evict if the cache is too large
+    def put(self, account_id, nrql, results):
+        entry = {
+            "account": account_id,
+            "nrql": normalize_nrql(nrql),
+            "storedAt": time.time(),
+            "results": results,
+        }
+
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self.path(cache_key(account_id, nrql)))
+        self.evict()
+
+    # Remove least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
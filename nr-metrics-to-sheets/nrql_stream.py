@@ -0,0 +1,134 @@
+import json, codecs
+
+# Whitespace allowed between JSON tokens
+WHITESPACE = " \t\r\n"
+
+# Characters that may follow a complete JSON value
+DELIMITERS = WHITESPACE + ",:]}"
+
+# Trim the consumed part of the buffer once it grows past this many characters
+TRIM_AT = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
+
+# Incremental parser for NerdGraph responses
+# Iterating yields (alias, entry) for every element of every "results" array,
+# where alias is the key the results sit under ("nrql", or "q0", "q1", ... in a
+# batched document). Each entry is decoded as soon as it is complete, so memory
+# stays flat no matter how many facets the response holds. The top-level
+# "errors" array, if any, is available in .errors once iteration finishes.
+class ResultsStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.errors = []
+        self.found_results = False
+
+    # Append the next chunk to the buffer; returns False once the input is exhausted
+    def read_more(self):
+        if self.eof:
+            return False
+        if self.pos > TRIM_AT:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += self.decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+                return True
+        self.buffer += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    # Next non-whitespace character, reading more input as needed (None at the end)
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return None
+
+    # Decode one complete JSON value at the current position
+    # A number cut at a chunk boundary decodes as a shorter number ("6500" of
+    # "6500.5"), so a value is only accepted once a delimiter follows it
+    def decode_value(self):
+        while True:
+            self.peek()
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in DELIMITERS):
+                    self.pos = end
+                    return value
+            self.read_more()
+
+    # Skip over one JSON value without building it, unless it holds results
+    # `name` is the key the value sits under, `parent` the key of its container
+    def walk_value(self, name, parent, depth):
+        char = self.peek()
+        if char == "{":
+            self.pos += 1
+            yield from self.walk_object(name, depth + 1)
+        elif char == "[":
+            self.pos += 1
+            if name == "results":
+                yield from self.walk_results(parent)
+            else:
+                yield from self.walk_array(name, depth + 1)
+        else:
+            self.decode_value()
+
+    def walk_object(self, name, depth):
+        while True:
+            char = self.peek()
+            if char == "}":
+                self.pos += 1
+                return
+            if char == ",":
+                self.pos += 1
+                continue
+            key = self.decode_value()
+            if self.peek() != ":":
+                raise ValueError("Malformed NerdGraph response")
+            self.pos += 1
+            if key == "errors" and depth == 1:
+                self.errors = self.decode_value()
+            else:
+                yield from self.walk_value(key, name, depth)
+
+    def walk_array(self, name, depth):
+        while True:
+            char = self.peek()
+            if char == "]":
+                self.pos += 1
+                return
+            if char == ",":
+                self.pos += 1
+                continue
+            yield from self.walk_value(None, name, depth)
+
+    # Decode the elements of a results array one at a time
+    def walk_results(self, alias):
+        self.found_results = True
+        while True:
+            char = self.peek()
+            if char == "]":
+                self.pos += 1
+                return
+            if char == ",":
+                self.pos += 1
+                continue
+            yield alias, self.decode_value()
+
+    def __iter__(self):
+        if self.peek() is None:
+            return
+        yield from self.walk_value(None, None, 0)
@@ -0,0 +1,158 @@
+import os, json, sqlite3, argparse, datetime, threading
+from dotenv import load_dotenv
+
+# Run on its own, outbox.py loads the .env file (for local development) before
+# reading its settings; otherwise the entry point has loaded it already
+if __name__ == "__main__":
+    load_dotenv()
+
+# Write-ahead log of the rows going to Google Sheets
+# Every append is stored here before it is sent and marked sent once Sheets
+# accepted it, so a failed write can be retried with `python outbox.py flush`
+# instead of querying New Relic again. Writes are keyed by run ID, worksheet and
+# their order within the run: a re-run with the same NR_RUN_ID skips the writes
+# its first attempt already sent and sends the stored rows of the others.
+OUTBOX_PATH = os.getenv("NR_OUTBOX_DB", os.path.join("outbox", "outbox.sqlite"))
+
+# Sent writes are deleted after this many days
+KEEP_DAYS = float(os.getenv("NR_OUTBOX_KEEP_DAYS", "35"))
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+
+
+# NR_RUN_ID if set, otherwise one ID per process
+def default_run_id():
+    return os.getenv("NR_RUN_ID") or f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S}-{os.getpid()}"
+
+
+class Outbox:
+    def __init__(self, path=None, run_id=None):
+        self.path = path or OUTBOX_PATH
+        self.run_id = run_id or default_run_id()
+        self.lock = threading.Lock()
+        self.sequences = {}
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS writes ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "run_id TEXT NOT NULL, "
+                "worksheet TEXT NOT NULL, "
+                "seq INTEGER NOT NULL, "
+                "rows TEXT NOT NULL, "
+                "created_at TEXT NOT NULL, "
+                "sent_at TEXT, "
+                "UNIQUE (run_id, worksheet, seq))"
+            )
+        conn.close()
+
+    # Build the outbox from the environment, or None when NR_OUTBOX=0
+    @classmethod
+    def from_env(cls):
+        if os.getenv("NR_OUTBOX", "1") == "0":
+            return None
+        return cls()
+
+    def connect(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return sqlite3.connect(self.path, timeout=30)
+
+    # Store the next write of this run to a worksheet
+    # Returns (id, rows) to send, with the rows stored by an earlier attempt of
+    # the run if there was one, or None if that attempt already sent them
+    def add(self, worksheet, rows):
+        with self.lock:
+            seq = self.sequences.get(worksheet, 0)
+            self.sequences[worksheet] = seq + 1
+            with self.connect() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO writes (run_id, worksheet, seq, rows, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (self.run_id, worksheet, seq, json.dumps(rows, default=str), now()),
+                )
+                write_id, stored, sent_at = conn.execute(
+                    "SELECT id, rows, sent_at FROM writes WHERE run_id = ? AND worksheet = ? AND seq = ?",
+                    (self.run_id, worksheet, seq),
+                ).fetchone()
+            conn.close()
+        if sent_at is not None:
+            return None
+        return write_id, json.loads(stored)
+
+    def mark_sent(self, ids):
+        if not ids:
+            return
+        with self.lock:
+            with self.connect() as conn:
+                conn.executemany("UPDATE writes SET sent_at = ? WHERE id = ?", [(now(), write_id) for write_id in ids])
+            conn.close()
+
+    # Writes not sent yet, oldest first, as (id, run_id, worksheet, rows)
+    def pending(self, run_id=None):
+        with self.lock:
+            with self.connect() as conn:
+                query = "SELECT id, run_id, worksheet, rows FROM writes WHERE sent_at IS NULL"
+                params = ()
+                if run_id:
+                    query += " AND run_id = ?"
+                    params = (run_id,)
+                entries = conn.execute(query + " ORDER BY id", params).fetchall()
+            conn.close()
+        return [(write_id, run, worksheet, json.loads(rows)) for write_id, run, worksheet, rows in entries]
+
+    def prune(self, days=None):
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days or KEEP_DAYS)
+        with self.lock:
+            with self.connect() as conn:
+                conn.execute("DELETE FROM writes WHERE sent_at IS NOT NULL AND sent_at < ?",
+                             (cutoff.isoformat(timespec="seconds"),))
+            conn.close()
+
+
+# The outbox is opened on first use and shared by all collectors
+_outbox = None
+_outbox_loaded = False
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    global _outbox, _outbox_loaded
+    with _outbox_lock:
+        if not _outbox_loaded:
+            _outbox = Outbox.from_env()
+            _outbox_loaded = True
+    return _outbox
+
+
+# Send the pending writes (of one run, or all) to Sheets in one batched write
+# Returns the number of writes sent
+def flush(outbox, run_id=None):
+    import sheets
+    entries = outbox.pending(run_id)
+    if not entries:
+        return 0
+    rows_by_worksheet = {}
+    for _, _, worksheet, rows in entries:
+        rows_by_worksheet.setdefault(worksheet, []).extend(rows)
+    sheets.append_to_worksheets(rows_by_worksheet)
+    outbox.mark_sent([write_id for write_id, _, _, _ in entries])
+    outbox.prune()
+    return len(entries)
+
+
+# Main execution block
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show or resend Sheets writes kept in the outbox.")
+    parser.add_argument("command", choices=["flush", "pending"],
+                        help="flush: send the pending writes to Sheets; pending: list them")
+    parser.add_argument("--run-id", help="only the writes of this run")
+    args = parser.parse_args()
+
+    outbox = Outbox()
+    if args.command == "pending":
+        entries = outbox.pending(args.run_id)
+        for write_id, run_id, worksheet, rows in entries:
+            print(f"{write_id}\t{run_id}\t{worksheet}\t{len(rows)} rows")
+        print(f"{len(entries)} pending writes")
+    else:
+        print(f"Sent {flush(outbox, args.run_id)} pending writes to Google Sheets.")
@@ -0,0 +1,131 @@
+import os, sys, time, threading, contextlib
+
+# Sampling profiler for a whole run, written as folded stacks
+# (one "frame;frame;... count" line per distinct stack), the input format of
+# flamegraph.pl, speedscope and inferno. Each stack starts with the phase the
+# thread was in: [auth], [fetch], [transform] or [write]. The shared layers mark
+# their phases (sheets.py auth, nerdgraph.py fetch, sinks.py write) and run.py
+# marks each collector as transform, so whatever a collector does outside the
+# other three counts as transforming results into rows. A thread blocked on the
+# worker threads it started (engine.run_concurrently) is in [wait], and the
+# workers carry on the phase of the thread that started them.
+# Sampling looks at every thread, so time spent waiting on the network or on
+# the rate limiter shows up too, which is the point for an I/O-bound job.
+
+# Phase stack of every thread currently inside a phase, by thread ident
+_phases = {}
+_active = False
+
+
+@contextlib.contextmanager
+def _enter(name):
+    ident = threading.get_ident()
+    stack = _phases.setdefault(ident, [])
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+        if not stack:
+            _phases.pop(ident, None)
+
+
+# Mark the code inside the block as part of `name`; free while not profiling
+def phase(name):
+    if not _active:
+        return contextlib.nullcontext()
+    return _enter(name)
+
+
+# Phase of the calling thread, or None
+def current():
+    stack = _phases.get(threading.get_ident())
+    return stack[-1] if stack else None
+
+
+# Wrap fn so the thread it runs on is in the calling thread's phase
+def inherit(fn):
+    name = current() if _active else None
+    if name is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with _enter(name):
+            return fn(*args, **kwargs)
+    return run
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            # The thread may leave its last phase at any moment, emptying the stack
+            try:
+                name = _phases[ident][-1]
+            except (KeyError, IndexError):
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(frame_label(frame))
+                frame = frame.f_back
+            folded = ";".join([f"[{name}]"] + frames[::-1])
+            self.stacks[folded] = self.stacks.get(folded, 0) + 1
+            self.samples[name] = self.samples.get(name, 0) + 1
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        global _active
+        _active = True
+        self.thread = threading.Thread(target=self.loop, name="profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        global _active
+        self.stopped.set()
+        self.thread.join()
+        _active = False
+
+    # Seconds of thread time seen in each phase, largest first
+    def phase_seconds(self):
+        return sorted(((name, count * self.interval) for name, count in self.samples.items()), key=lambda item: -item[1])
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            for folded, count in sorted(self.stacks.items()):
+                f.write(f"{folded} {count}\n")
+
+
+# Profile everything run inside the block and write the folded stacks to `path`
+@contextlib.contextmanager
+def profile(path, interval=0.005):
+    profiler = SamplingProfiler(interval).start()
+    started = time.perf_counter()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.write(path)
+        phases = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in profiler.phase_seconds())
+        print(f"Profile: {time.perf_counter() - started:.1f}s wall; thread time by phase: {phases or 'none'}")
+        print(f"Profile written to {path} (folded stacks, e.g. flamegraph.pl {path} > profile.svg)")
@@ -0,0 +1,232 @@
+import os, re, json, time, hashlib, threading, contextlib
+from recording import replay_key
+
+# Directory the end-of-run metrics are written to; NR_METRICS=0 turns them off
+METRICS_DIR = os.getenv("NR_METRICS_DIR", "metrics")
+
+# Pieces of NRQL used to label a query
+SERVICE = re.compile(r"\b(?:appName|entity\.name|entityGuid)\s*=\s*'([^']*)'", re.IGNORECASE)
+SERVICE_LIST = re.compile(r"\b(?:appName|entity\.name|entityGuid)\s+IN\s*\(", re.IGNORECASE)
+SOURCE = re.compile(r"\bFROM\s+(\w+)", re.IGNORECASE)
+WINDOW = re.compile(r"\bSINCE\s+(\d{10,})\s+UNTIL\s+(\d{10,})\b", re.IGNORECASE)
+
+
+# Stable ID of a query across runs: its replay key (window masked), hashed
+def query_id(nrql):
+    return hashlib.sha256(replay_key(nrql).encode()).hexdigest()[:12]
+
+
+# Service a query is about, "(many)" for IN (...) lists, "" if none
+def query_service(nrql):
+    match = SERVICE.search(nrql)
+    if match:
+        return match.group(1)
+    return "(many)" if SERVICE_LIST.search(nrql) else ""
+
+
+# Escape a label value for the OpenMetrics text format
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    return ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items())
+
+
+# One HTTP request to NerdGraph and the queries it carried
+class RequestRecord:
+    def __init__(self, kind, nrqls):
+        self.kind = kind
+        self.nrqls = nrqls
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+        self.bytes = 0
+        self.accounted_bytes = 0
+        self.error = None
+
+
+# Collects timing, size, retry and NRQL metadata for every NerdGraph request
+# A batched request's time and bytes are shared evenly between its queries.
+# NerdGraph does not report inspected event counts for NRQL, so the cost of a
+# query is shown by its time, response bytes, result rows and window length.
+class QueryMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.kinds = {}
+        self.queries = {}
+        self.started = time.time()
+
+    def query(self, nrql):
+        key = query_id(nrql)
+        entry = self.queries.get(key)
+        if entry is None:
+            window = WINDOW.search(nrql)
+            source = SOURCE.search(nrql)
+            entry = self.queries[key] = {
+                "id": key,
+                "nrql": replay_key(nrql),
+                "service": query_service(nrql),
+                "source": source.group(1) if source else "",
+                "kinds": [],
+                "windowSeconds": (int(window.group(2)) - int(window.group(1))) / 1000 if window else None,
+                "requests": 0, "failures": 0, "lastFailed": False, "seconds": 0.0, "bytes": 0.0, "results": None,
+                "eventTypes": None, "messages": [], "errors": [],
+            }
+        return entry
+
+    # Time one request; inside it, add_bytes() and answered() fill in the record
+    @contextlib.contextmanager
+    def request(self, kind, nrqls):
+        record = RequestRecord(kind, nrqls)
+        self.local.record = record
+        try:
+            yield record
+        except Exception as e:
+            record.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.local.record = None
+            self.finish(record, time.perf_counter() - record.started)
+
+    # Response bytes of the request running on this thread, if any
+    def add_bytes(self, size):
+        record = getattr(self.local, "record", None)
+        if record is not None:
+            record.bytes += size
+
+    # Account for a finished request
+    def finish(self, record, seconds):
+        failed = record.error is not None
+        share = 1 / max(1, len(record.nrqls))
+        with self.lock:
+            kind = self.kinds.setdefault(record.kind, {"requests": 0, "failures": 0, "seconds": 0.0, "bytes": 0})
+            kind["requests"] += 1
+            kind["failures"] += failed
+            kind["seconds"] += seconds
+            kind["bytes"] += record.bytes
+            for nrql in record.nrqls:
+                entry = self.query(nrql)
+                entry["requests"] += 1
+                entry["failures"] += failed
+                entry["lastFailed"] = failed
+                entry["seconds"] += seconds * share
+                entry["bytes"] += record.bytes * share
+                if record.kind not in entry["kinds"]:
+                    entry["kinds"].append(record.kind)
+                if failed:
+                    entry["errors"].append(record.error)
+        record.seconds = seconds
+        record.accounted_bytes = record.bytes
+
+    # Account for time spent and bytes read after the request finished,
+    # e.g. reading the rest of a streamed body
+    def extend(self, record, seconds):
+        size = record.bytes - record.accounted_bytes
+        share = 1 / max(1, len(record.nrqls))
+        with self.lock:
+            kind = self.kinds[record.kind]
+            kind["seconds"] += seconds
+            kind["bytes"] += size
+            for nrql in record.nrqls:
+                entry = self.query(nrql)
+                entry["seconds"] += seconds * share
+                entry["bytes"] += size * share
+        record.seconds += seconds
+        record.accounted_bytes = record.bytes
+
+    # Result rows and NerdGraph metadata (event types, warnings) of an answered query
+    def answered(self, nrql, results=None, metadata=None):
+        with self.lock:
+            entry = self.query(nrql)
+            if results is not None:
+                entry["results"] = len(results) if isinstance(results, list) else results
+            metadata = metadata or {}
+            if metadata.get("eventTypes"):
+                entry["eventTypes"] = metadata["eventTypes"]
+            for message in metadata.get("messages") or []:
+                if message not in entry["messages"]:
+                    entry["messages"].append(message)
+
+    def summary(self):
+        with self.lock:
+            queries = sorted((dict(entry) for entry in self.queries.values()), key=lambda e: -e["seconds"])
+            kinds = {name: dict(values) for name, values in self.kinds.items()}
+
+        services = {}
+        for entry in queries:
+            service = services.setdefault(entry["service"], {"queries": 0, "requests": 0, "seconds": 0.0, "bytes": 0.0})
+            service["queries"] += 1
+            service["requests"] += entry["requests"]
+            service["seconds"] += entry["seconds"]
+            service["bytes"] += entry["bytes"]
+        # Every failure but a final one was followed by a retry
+        for entry in queries:
+            entry["retries"] = entry["failures"] - entry.pop("lastFailed")
+
+        return {
+            "startedAt": self.started,
+            "durationSeconds": time.time() - self.started,
+            "requests": sum(kind["requests"] for kind in kinds.values()),
+            "failures": sum(kind["failures"] for kind in kinds.values()),
+            "seconds": sum(kind["seconds"] for kind in kinds.values()),
+            "bytes": sum(kind["bytes"] for kind in kinds.values()),
+            "byKind": kinds,
+            "byService": dict(sorted(services.items(), key=lambda item: -item[1]["seconds"])),
+            "queries": queries,
+        }
+
+    # The summary in the OpenMetrics text format
+    def openmetrics(self, summary=None):
+        summary = summary or self.summary()
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"# HELP {name} {help_text}")
+            suffix = "_total" if kind == "counter" else ""
+            for labels, value in samples:
+                lines.append(f"{name}{suffix}{{{format_labels(labels)}}} {value}")
+
+        kinds = summary["byKind"].items()
+        family("nerdgraph_requests", "counter", "HTTP requests sent to NerdGraph.",
+               [({"kind": name}, values["requests"]) for name, values in kinds])
+        family("nerdgraph_request_failures", "counter", "NerdGraph requests that raised an error.",
+               [({"kind": name}, values["failures"]) for name, values in kinds])
+        family("nerdgraph_request_seconds", "counter", "Time spent in NerdGraph requests.",
+               [({"kind": name}, round(values["seconds"], 6)) for name, values in kinds])
+        family("nerdgraph_response_bytes", "counter", "Bytes of NerdGraph response bodies.",
+               [({"kind": name}, values["bytes"]) for name, values in kinds])
+
+        queries = summary["queries"]
+
+        def labels(entry):
+            return {"query": entry["id"], "service": entry["service"], "source": entry["source"]}
+
+        family("nerdgraph_query_requests", "counter", "Requests that carried the query, retries included.",
+               [(labels(e), e["requests"]) for e in queries])
+        family("nerdgraph_query_retries", "counter", "Times the query was sent again after a failure.",
+               [(labels(e), e["retries"]) for e in queries])
+        family("nerdgraph_query_seconds", "counter", "Request time attributed to the query.",
+               [(labels(e), round(e["seconds"], 6)) for e in queries])
+        family("nerdgraph_query_response_bytes", "counter", "Response bytes attributed to the query.",
+               [(labels(e), round(e["bytes"])) for e in queries])
+        family("nerdgraph_query_results", "gauge", "Result rows the query returned.",
+               [(labels(e), e["results"]) for e in queries if e["results"] is not None])
+        family("nerdgraph_query_window_seconds", "gauge", "Length of the query's time window.",
+               [(labels(e), e["windowSeconds"]) for e in queries if e["windowSeconds"] is not None])
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    # Write nerdgraph.prom and nerdgraph.json; returns the directory, or None if nothing ran
+    def write(self, directory=None):
+        if not self.kinds or os.getenv("NR_METRICS", "1") == "0":
+            return None
+        directory = directory or METRICS_DIR
+        os.makedirs(directory, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(directory, "nerdgraph.prom"), "w") as f:
+            f.write(self.openmetrics(summary))
+        with open(os.path.join(directory, "nerdgraph.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        return directory
@@ -0,0 +1,47 @@
+import os, re, json, threading
+from nrql_cache import normalize_nrql
+
+# Absolute windows written by time_window.resolve_window
+# They are masked in the replay key, so a recording made in one run answers
+# the same query in any later run
+EPOCH_WINDOW = re.compile(r"\b(SINCE|UNTIL)\s+\d{10,}\b", re.IGNORECASE)
+
+
+# Key a recorded query is looked up by: its normalized NRQL with the window masked
+def replay_key(nrql):
+    return EPOCH_WINDOW.sub(lambda m: f"{m.group(1).upper()} <time>", normalize_nrql(nrql))
+
+
+# Appends every query the client answers, with its results, to a JSONL file
+# that replay_server.py can serve. Each line is {"nrql": ..., "results": [...]};
+# a line may also be given a "latency" in seconds by hand.
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    # Build a recorder from the environment, or None unless NR_RECORD_FILE is set
+    @classmethod
+    def from_env(cls):
+        path = os.getenv("NR_RECORD_FILE")
+        return cls(path) if path else None
+
+    def record(self, nrql, results):
+        line = json.dumps({"nrql": normalize_nrql(nrql), "results": results})
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+# Load a recording into {replay key: entry}; later lines win
+def load_recording(path):
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entries[replay_key(entry["nrql"])] = entry
+    return entries
@@ -0,0 +1,257 @@
+import re, json, time, random, hashlib, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from recording import replay_key, load_recording
+
+# Local stand-in for the NerdGraph API, answering NRQL queries from a recording
+# made with NR_RECORD_FILE. Point the collectors at it with
+# NEW_RELIC_GRAPHQL_URL=http://127.0.0.1:<port>/graphql
+#
+# It understands the three documents nerdgraph.py sends: a single nrql field
+# (sync or async), a batch of aliased q0, q1, ... nrql fields, and
+# nrqlQueryProgress. Latency, TIMEOUT errors, HTTP 429 and response size can be
+# injected to see how the client and the collectors cope.
+
+# One aliased field of a batched document, e.g. q3: nrql(query: "...") { results }
+BATCH_FIELD = re.compile(r'\b(q\d+):\s*nrql\(query:\s*("(?:[^"\\]|\\.)*")')
+
+# Pieces of NRQL the synthetic answers are shaped from
+SELECT_ALIAS = re.compile(r"\bAS\s+(`[^`]+`|'[^']+'|\w+)", re.IGNORECASE)
+FACET_CLAUSE = re.compile(r"\bFACET\s+(.*?)(?=\s+(?:LIMIT|TIMESERIES|SINCE|UNTIL|ORDER)\b|$)", re.IGNORECASE)
+IN_LIST = re.compile(r"\bIN\s*\(([^)]*)\)", re.IGNORECASE)
+TIMESERIES = re.compile(r"\bTIMESERIES\s+(\d+)\s+(minute|hour|day|week)s?\b", re.IGNORECASE)
+WINDOW = re.compile(r"\bSINCE\s+(\d{10,})\s+UNTIL\s+(\d{10,})\b", re.IGNORECASE)
+SOURCE = re.compile(r"\bFROM\s+(\w+)", re.IGNORECASE)
+
+BUCKET_SECONDS = {"minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+
+
+# Results shaped like the query asks for, for queries missing from the recording
+# Every selected alias gets a positive number (lastSeen-style aliases a timestamp),
+# FACET ... WHERE x IN (...) gets one facet per listed value, other FACET queries
+# get `facets` numeric-string facets, and TIMESERIES gets one bucket per step
+def synthetic_results(nrql, facets=3):
+    rng = random.Random(hashlib.sha256(replay_key(nrql).encode()).hexdigest())
+    aliases = [alias.strip("`'") for alias in SELECT_ALIAS.findall(nrql.split(" FACET ")[0])]
+    now_ms = int(time.time() * 1000)
+
+    def values():
+        return {
+            alias: now_ms if "seen" in alias.lower() or "timestamp" in alias.lower() else rng.randint(1, 1000)
+            for alias in aliases
+        }
+
+    facet_match = FACET_CLAUSE.search(nrql)
+    if facet_match:
+        attributes = len(facet_match.group(1).split(","))
+        in_list = IN_LIST.search(nrql)
+        if in_list and attributes == 1:
+            names = [name.strip().strip("'\"") for name in in_list.group(1).split(",") if name.strip()]
+        else:
+            names = [str(500 + i) for i in range(facets)]
+        keys = [name if attributes == 1 else [name] * attributes for name in names]
+    else:
+        keys = [None]
+
+    buckets = [None]
+    series, window = TIMESERIES.search(nrql), WINDOW.search(nrql)
+    if series and window:
+        step = int(series.group(1)) * BUCKET_SECONDS[series.group(2).lower()]
+        since, until = int(window.group(1)) // 1000, int(window.group(2)) // 1000
+        buckets = [(start, min(start + step, until)) for start in range(since, until, step)]
+
+    results = []
+    for key in keys:
+        for bucket in buckets:
+            entry = values()
+            if key is not None:
+                entry["facet"] = key
+            if bucket is not None:
+                entry["beginTimeSeconds"], entry["endTimeSeconds"] = bucket
+            results.append(entry)
+    return results
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        payload = json.loads(body or b"{}")
+        status, headers, answer = self.server.answer(payload.get("query", ""), payload.get("variables") or {})
+        out = json.dumps(answer).encode()
+        self.server.count(bytes_in=len(body), bytes_out=len(out))
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    # GET /stats returns the counters as JSON
+    def do_GET(self):
+        out = json.dumps(self.server.snapshot()).encode()
+        self.send_response(200 if self.path.rstrip("/") == "/stats" else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # `recording` is a path made with NR_RECORD_FILE (or None to synthesize everything)
+    # `latency` seconds per query (a recorded "latency" wins), plus up to `jitter`
+    # `timeout_rate` share of queries answered with an NRQL TIMEOUT error
+    # `rate_limit_rate` share of requests answered with HTTP 429 and Retry-After
+    # `pad_bytes` padding added to every answered query, to test large responses
+    def __init__(self, address=("127.0.0.1", 0), recording=None, synthesize=True, facets=3,
+                 latency=0.0, jitter=0.0, timeout_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1, pad_bytes=0, seed=None):
+        super().__init__(address, ReplayHandler)
+        self.entries = load_recording(recording) if recording else {}
+        self.synthesize = synthesize
+        self.facets = facets
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.pad_bytes = pad_bytes
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/graphql"
+
+    # Serve in a background thread; returns the server
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def reset(self):
+        with self.lock:
+            self.stats = {
+                "requests": 0, "queries": 0, "bytesIn": 0, "bytesOut": 0,
+                "replayed": 0, "synthesized": 0, "missing": 0, "timeouts": 0, "rateLimited": 0,
+            }
+
+    def count(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                self.stats[{"bytes_in": "bytesIn", "bytes_out": "bytesOut"}.get(name, name)] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def chance(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    # Results and latency for one query, or an error dict
+    def lookup(self, nrql):
+        entry = self.entries.get(replay_key(nrql))
+        if entry is not None:
+            self.count(replayed=1)
+            return entry["results"], entry.get("latency", self.latency), None
+        if self.synthesize:
+            self.count(synthesized=1)
+            return synthetic_results(nrql, self.facets), self.latency, None
+        self.count(missing=1)
+        return None, self.latency, {"message": f"No recording for query: {nrql}"}
+
+    # Answer one NRQL query as the field `alias`; returns (field, error, latency)
+    def answer_nrql(self, alias, nrql, asynchronous=False):
+        self.count(queries=1)
+        results, latency, error = self.lookup(nrql)
+        if error is None and self.chance(self.timeout_rate):
+            self.count(timeouts=1)
+            error = {
+                "message": "NRDB query duration exceeded the timeout",
+                "extensions": {"errorClass": "TIMEOUT"},
+            }
+        if error is not None:
+            error["path"] = ["actor", "account", alias]
+            return None, error, latency
+
+        source = SOURCE.search(nrql)
+        field = {"results": results, "metadata": {"eventTypes": [source.group(1)] if source else [], "messages": []}}
+        if asynchronous:
+            field["queryProgress"] = {"queryId": None, "completed": True, "retryAfter": None, "retryDeadline": None}
+        if self.pad_bytes:
+            field["padding"] = "x" * self.pad_bytes
+        return field, None, latency
+
+    # Build the (status, headers, body) of a GraphQL request
+    def answer(self, query, variables):
+        self.count(requests=1)
+        if self.chance(self.rate_limit_rate):
+            self.count(rateLimited=1)
+            return 429, {"Retry-After": str(self.retry_after)}, {"errors": [{"message": "Too many requests"}]}
+
+        if "nrqlQueryProgress" in query:
+            error = {"message": "Unknown query ID", "path": ["actor", "account", "nrqlQueryProgress"]}
+            return 200, {}, {"data": {"actor": {"account": {"nrqlQueryProgress": None}}}, "errors": [error]}
+
+        if "nrql" in variables:
+            asked = [("nrql", variables["nrql"])]
+            asynchronous = "async: true" in query
+        else:
+            asked = [(alias, json.loads(literal)) for alias, literal in BATCH_FIELD.findall(query)]
+            asynchronous = False
+
+        account, errors, latency = {}, [], 0.0
+        for alias, nrql in asked:
+            field, error, query_latency = self.answer_nrql(alias, nrql, asynchronous)
+            account[alias] = field
+            if error is not None:
+                errors.append(error)
+            latency = max(latency, query_latency)  # Aliased queries run side by side
+
+        # Queries of one request run in parallel, so the slowest sets the delay
+        if latency or self.jitter:
+            with self.lock:
+                extra = self.random.uniform(0, self.jitter)
+            time.sleep(latency + extra)
+
+        body = {"data": {"actor": {"account": account}}}
+        if errors:
+            body["errors"] = errors
+        return 200, {}, body
+
+
+# Main execution block
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded NerdGraph NRQL responses locally.")
+    parser.add_argument("--recording", help="JSONL file written with NR_RECORD_FILE")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--no-synthesize", action="store_true",
+                        help="answer queries missing from the recording with an error instead of made-up results")
+    parser.add_argument("--facets", type=int, default=3, help="facets in synthetic FACET results")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per query")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds per request")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="share of queries failing with TIMEOUT")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with HTTP 429")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--pad-bytes", type=int, default=0, help="padding added to every query's response")
+    parser.add_argument("--seed", type=int, help="seed for latency jitter and error injection")
+    args = parser.parse_args()
+
+    server = ReplayServer(
+        (args.host, args.port), recording=args.recording, synthesize=not args.no_synthesize,
+        facets=args.facets, latency=args.latency, jitter=args.jitter, timeout_rate=args.timeout_rate,
+        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, pad_bytes=args.pad_bytes, seed=args.seed,
+    )
+    print(f"Replaying {len(server.entries)} recorded queries on {server.url} (stats at /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Stopped: {json.dumps(server.snapshot())}")
@@ -0,0 +1,74 @@
+import os
+from time_window import get_run_anchor
+
+# Rotation of report worksheets into shards, so no tab grows without bound
+# With NR_ROTATE=quarter rows for "APM Metrics Report" go to the tab
+# "APM Metrics Report 2026-Q4" (month: "2026-10", year: "2026"), dated by the
+# run anchor. With a row or cell limit, a shard that would grow past it is
+# followed by "<name> (2)", "<name> (3)", ... Limits count the rows of data in
+# the tab (its filled column A), header included. New shards get the header rows
+# (the frozen rows, or the first row) of the original tab.
+ROTATE = os.getenv("NR_ROTATE", "none")
+MAX_ROWS = int(os.getenv("NR_ROTATE_MAX_ROWS", "0"))
+MAX_CELLS = int(os.getenv("NR_ROTATE_MAX_CELLS", "0"))
+
+PERIODS = ("none", "month", "quarter", "year")
+
+
+def enabled():
+    return ROTATE != "none" or bool(MAX_ROWS or MAX_CELLS)
+
+
+# Calendar part of a shard's title, e.g. "2026-Q4", or None without calendar rotation
+def period_label(moment=None, period=None):
+    period = period or ROTATE
+    if period not in PERIODS:
+        raise ValueError(f"NR_ROTATE must be one of {', '.join(PERIODS)}, not {period!r}")
+    if period == "none":
+        return None
+    moment = moment or get_run_anchor()
+    if period == "month":
+        return f"{moment.year}-{moment.month:02d}"
+    if period == "quarter":
+        return f"{moment.year}-Q{(moment.month - 1) // 3 + 1}"
+    return str(moment.year)
+
+
+# Title of the n-th shard of a worksheet for a calendar label
+def shard_title(title, label, n=1):
+    name = f"{title} {label}" if label else title
+    return name if n == 1 else f"{name} ({n})"
+
+
+# Whether adding `rows` rows to a tab holding `used_rows` rows of data would
+# take it past the limits
+def too_full(used_rows, col_count, rows):
+    total = used_rows + rows
+    return bool((MAX_ROWS and total > MAX_ROWS) or (MAX_CELLS and total * col_count > MAX_CELLS))
+
+
+# Existing shards of a worksheet for a calendar label, oldest first
+# `tabs` holds the titles of the workbook's tabs
+def existing_shards(title, tabs, label=None):
+    shards = []
+    while shard_title(title, label, len(shards) + 1) in tabs:
+        shards.append(shard_title(title, label, len(shards) + 1))
+    return shards
+
+
+# Tab the rows of worksheet `title` go to, as (tab, pinned)
+# `holds_block(tab)` tells whether a tab already holds one of the rows' date
+# blocks; such a tab is pinned, so a re-run overwrites its block where it is
+# whatever the tab's size. Otherwise it is the latest shard, which the caller
+# replaces with next_shard() once it knows the shard is too_full(), or the
+# first shard if there is none yet.
+def choose_shard(title, tabs, holds_block, label=None):
+    shards = existing_shards(title, tabs, label)
+    for shard in shards:
+        if holds_block(shard):
+            return shard, True
+    return (shards[-1] if shards else shard_title(title, label)), False
+
+
+def next_shard(title, tabs, label=None):
+    return shard_title(title, label, len(existing_shards(title, tabs, label)) + 1)
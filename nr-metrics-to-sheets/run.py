@@ -0,0 +1,108 @@
+import argparse, importlib, traceback, contextlib
+from dotenv import load_dotenv
+
+# Load environment variables from .env file (for local development), once for
+# all collectors and before the shared modules read their settings
+# In GitHub Actions, these will be provided as environment variables
+load_dotenv()
+
+import engine
+import sinks
+import profiling
+
+# Collector module of each report, per period, keyed by its command-line name
+COLLECTORS = {
+    "daily": {
+        "apm": "fetch_nr",
+        "error-logs": "fetch_nr_err_logs",
+        "hosts": "fetch_nr_hosts",
+        "5xx": "fetch_nr_5XX_errors",
+    },
+    "weekly": {
+        "apm": "fetch_nr_weekly",
+        "error-logs": "fetch_nr_err_logs_weekly",
+        "hosts": "fetch_nr_hosts_weekly",
+        "5xx": "fetch_nr_5XX_errors_weekly",
+    },
+    "monthly": {
+        "apm": "fetch_nr_monthly",
+        "error-logs": "fetch_nr_err_logs_montly",
+        "hosts": "fetch_nr_hosts_monthly",
+        "5xx": "fetch_nr_5XX_errors_monthly",
+        "badly-handled": "badly_handled_error_rate",
+        "transaction-success": "transaction_success_rate",
+    },
+}
+
+
+# Run one collector, returning its error instead of raising it so the
+# other collectors of the run still finish
+# Whatever the collector does outside fetching and writing is profiled as transform
+def run_collector(collector):
+    name, module = collector
+    try:
+        with profiling.phase("transform"):
+            module.main()
+    except Exception as e:
+        print(f"Collector {name} failed:")
+        traceback.print_exc()
+        return e
+    return None
+
+
+# Run the named collectors of a period concurrently in this process
+# They share the NerdGraph client, the Sheets client and the open workbook
+# Returns the names of the collectors that failed
+def run(period, names):
+    collectors = [(name, importlib.import_module(COLLECTORS[period][name])) for name in names]
+    errors = engine.run_concurrently(run_collector, collectors, limit=len(collectors))
+    return [name for (name, _), error in zip(collectors, errors) if error is not None]
+
+
+# Turn "all" or a comma-separated list into collector names
+def parse_collectors(value, period):
+    if value == "all":
+        return list(COLLECTORS[period])
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in COLLECTORS[period]]
+    if unknown:
+        raise ValueError(f"unknown {period} collectors: {', '.join(unknown)} "
+                         f"(choose from {', '.join(COLLECTORS[period])})")
+    return names
+
+
+# Main execution block
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run New Relic collectors into Google Sheets in one process.")
+    parser.add_argument("--period", required=True, choices=list(COLLECTORS), help="report period to collect")
+    parser.add_argument(
+        "--collectors", default="all",
+        help="'all' or a comma-separated list of collectors, e.g. apm,hosts",
+    )
+    parser.add_argument(
+        "--sinks",
+        help="comma-separated outputs: sheets, jsonl, csv, parquet (default: NR_SINKS or sheets)",
+    )
+    parser.add_argument(
+        "--profile", nargs="?", const="profile.folded", metavar="PATH",
+        help="sample the run and write folded stacks for a flame graph (default path: profile.folded)",
+    )
+    parser.add_argument("--profile-interval", type=float, default=0.005, help="seconds between profile samples")
+    args = parser.parse_args()
+
+    try:
+        names = parse_collectors(args.collectors, args.period)
+        if args.sinks:
+            sinks.configure(args.sinks)
+    except (ValueError, RuntimeError) as e:
+        parser.error(str(e))
+
+    # Rows of all collectors go to Sheets together once they have finished
+    with contextlib.ExitStack() as stack:
+        if args.profile:
+            stack.enter_context(profiling.profile(args.profile, args.profile_interval))
+        stack.enter_context(sinks.batch())
+        failed = run(args.period, names)
+    if failed:
+        raise SystemExit(f"Collectors failed: {', '.join(failed)}")
+    print(f"Successfully ran {len(names)} {args.period} collectors.")
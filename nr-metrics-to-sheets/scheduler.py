@@ -0,0 +1,149 @@
+import os, time, random, threading
+
+
+# Raised by the client for failures worth retrying after a pause:
+# HTTP 429, NerdGraph rate-limit errors and NRQL TIMEOUT errors
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None, rate_limited=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.rate_limited = rate_limited
+
+
+# Token bucket refilled continuously at `rate` tokens per second
+# Each NRQL query costs one token, so a batched request costs one per alias
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Block until `cost` tokens are available, then take them
+    def acquire(self, cost=1):
+        cost = min(cost, self.capacity)
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Halve the refill rate after the API pushed back
+    def slow_down(self):
+        with self.lock:
+            self.refill()
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+
+    # Creep back towards the configured rate after each success
+    def speed_up(self):
+        with self.lock:
+            self.refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+# Caps the number of NRQL queries running at the same time
+# A request holding more queries than the cap may still run when nothing else is
+class ConcurrencyLimit:
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, cost=1):
+        with self.condition:
+            while self.in_use and self.in_use + cost > self.limit:
+                self.condition.wait()
+            self.in_use += cost
+
+    def release(self, cost=1):
+        with self.condition:
+            self.in_use -= cost
+            self.condition.notify_all()
+
+
+# Scheduler in front of the NerdGraph client
+# Every request waits for tokens and a concurrency slot, and rate-limit or
+# TIMEOUT failures are retried with exponential backoff
+class Scheduler:
+    def __init__(self, queries_per_minute=3000, burst=None, max_concurrent=25,
+                 max_retries=4, backoff_base=2, backoff_max=60):
+        rate = queries_per_minute / 60
+        self.bucket = TokenBucket(rate, burst or max(1, max_concurrent))
+        self.slots = ConcurrencyLimit(max_concurrent)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Build a scheduler from the environment
+    @classmethod
+    def from_env(cls):
+        return cls(
+            queries_per_minute=float(os.getenv("NR_QUERIES_PER_MINUTE", "3000")),
+            max_concurrent=int(os.getenv("NR_MAX_CONCURRENT_QUERIES", "25")),
+            max_retries=int(os.getenv("NR_MAX_RETRIES", "4")),
+            backoff_base=float(os.getenv("NR_BACKOFF_BASE", "2")),
+            backoff_max=float(os.getenv("NR_BACKOFF_MAX", "60")),
+        )
+
+    # Wait out a backoff pause set by any worker
+    def wait_for_pause(self):
+        while True:
+            with self.lock:
+                remaining = self.paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    # Pause every worker for `delay` seconds (extends, never shortens, a pause)
+    def pause(self, delay):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    # Delay before retry number `attempt`, honouring Retry-After when given
+    def backoff_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after)
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)  # Jitter so workers do not retry in lockstep
+
+    # Run fn(*args) under the rate limits, retrying retryable failures
+    # `cost` is the number of NRQL queries the call sends
+    def call(self, fn, *args, cost=1):
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_pause()
+            self.bucket.acquire(cost)
+            self.slots.acquire(cost)
+            try:
+                result = fn(*args)
+            except RetryableError as e:
+                error = e
+            else:
+                self.bucket.speed_up()
+                return result
+            finally:
+                self.slots.release(cost)
+
+            if attempt == self.max_retries:
+                raise error
+            delay = self.backoff_delay(attempt, error.retry_after)
+            print(f"NerdGraph: {error}, retrying in {delay:.1f} seconds (retry {attempt + 1} of {self.max_retries})...")
+
+            # Rate limits apply to the whole account, so every worker backs off
+            # A query TIMEOUT only concerns this query
+            if error.rate_limited:
+                self.bucket.slow_down()
+                self.pause(delay)
+            else:
+                time.sleep(delay)
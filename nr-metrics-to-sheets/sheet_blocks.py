@@ -0,0 +1,99 @@
+import os, re, sqlite3, datetime, threading
+
+# Local index of where every date block was written: the rows of a worksheet
+# from its "▶ period ◀" separator to the last row of its data. A re-run for a
+# period that is already in the sheet overwrites its block in place instead of
+# appending a second one, and nothing has to be read back to find it.
+# The workflows cache it together with the outbox.
+INDEX_PATH = os.getenv("NR_BLOCK_INDEX_DB", os.path.join("outbox", "sheet_blocks.sqlite"))
+
+# First cell of a date separator row, e.g. "▶ Friday, May 14th 2025 ◀"
+SEPARATOR = re.compile(r"^▶ .* ◀$")
+
+
+def is_separator(row):
+    return bool(row) and isinstance(row[0], str) and bool(SEPARATOR.match(row[0]))
+
+
+# Split rows into (period, rows) blocks, each starting at a separator row
+# Rows before the first separator form a block with period None
+def split_blocks(rows):
+    blocks = []
+    for row in rows:
+        if is_separator(row) or not blocks:
+            blocks.append((row[0] if is_separator(row) else None, []))
+        blocks[-1][1].append(row)
+    return blocks
+
+
+class BlockIndex:
+    def __init__(self, path=None):
+        self.path = path or INDEX_PATH
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks ("
+                "spreadsheet TEXT NOT NULL, "
+                "worksheet TEXT NOT NULL, "
+                "period TEXT NOT NULL, "
+                "first_row INTEGER NOT NULL, "
+                "last_row INTEGER NOT NULL, "
+                "written_at TEXT NOT NULL, "
+                "PRIMARY KEY (spreadsheet, worksheet, period))"
+            )
+        conn.close()
+
+    # Build the index from the environment, or None when NR_BLOCK_INDEX=0
+    @classmethod
+    def from_env(cls):
+        if os.getenv("NR_BLOCK_INDEX", "1") == "0":
+            return None
+        return cls()
+
+    def connect(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return sqlite3.connect(self.path, timeout=30)
+
+    # (first_row, last_row) of a period's block, or None
+    def find(self, spreadsheet, worksheet, period):
+        with self.lock:
+            with self.connect() as conn:
+                found = conn.execute(
+                    "SELECT first_row, last_row FROM blocks WHERE spreadsheet = ? AND worksheet = ? AND period = ?",
+                    (spreadsheet, worksheet, period),
+                ).fetchone()
+            conn.close()
+        return found
+
+    # Record where blocks were written, as (period, first_row, last_row)
+    def record(self, spreadsheet, worksheet, blocks):
+        written_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        with self.lock:
+            with self.connect() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?)",
+                    [(spreadsheet, worksheet, period, first, last, written_at) for period, first, last in blocks],
+                )
+            conn.close()
+
+    # Rows were inserted (count > 0) or deleted (count < 0) at `row`:
+    # move the blocks below it by `count`
+    def shift(self, spreadsheet, worksheet, row, count):
+        with self.lock:
+            with self.connect() as conn:
+                conn.execute(
+                    "UPDATE blocks SET first_row = first_row + ?, last_row = last_row + ? "
+                    "WHERE spreadsheet = ? AND worksheet = ? AND first_row > ?",
+                    (count, count, spreadsheet, worksheet, row),
+                )
+            conn.close()
+
+    def forget(self, spreadsheet, worksheet, period):
+        with self.lock:
+            with self.connect() as conn:
+                conn.execute(
+                    "DELETE FROM blocks WHERE spreadsheet = ? AND worksheet = ? AND period = ?",
+                    (spreadsheet, worksheet, period),
+                )
+            conn.close()
@@ -0,0 +1,75 @@
+import os, json, threading, tempfile
+
+
+# Remembers which spreadsheet key a workbook title resolved to, and the gid
+# and layout of its worksheets, so later runs can open the workbook with
+# open_by_key instead of a Drive search by title, and skip fetching the
+# metadata again for every tab
+# The file looks like {"spreadsheets": {title: key}, "worksheets": {key: {title: properties}}}
+class SheetIds:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.spreadsheets = data.get("spreadsheets") or {}
+        self.worksheets = data.get("worksheets") or {}
+
+    # Build the resolver from the environment, or None when NR_SHEET_IDS=0
+    @classmethod
+    def from_env(cls):
+        path = os.getenv("NR_SHEET_IDS", os.path.join("sheet_ids", "sheet_ids.json"))
+        if path == "0":
+            return None
+        return cls(path)
+
+    def spreadsheet(self, title):
+        with self.lock:
+            return self.spreadsheets.get(title)
+
+    def remember_spreadsheet(self, title, key):
+        with self.lock:
+            if self.spreadsheets.get(title) == key:
+                return
+            self.spreadsheets[title] = key
+        self.save()
+
+    # Drop a key that no longer opens the workbook, and its worksheets
+    def forget_spreadsheet(self, title):
+        with self.lock:
+            key = self.spreadsheets.pop(title, None)
+            self.worksheets.pop(key, None)
+        self.save()
+
+    # Properties (sheetId, title, index, gridProperties) of a worksheet, or None
+    def worksheet(self, key, title):
+        with self.lock:
+            properties = (self.worksheets.get(key) or {}).get(title)
+            return dict(properties) if properties else None
+
+    # Replace the worksheets known for a spreadsheet, e.g. {title: properties}
+    def remember_worksheets(self, key, worksheets):
+        with self.lock:
+            if self.worksheets.get(key) == worksheets:
+                return
+            self.worksheets[key] = worksheets
+        self.save()
+
+    def forget_worksheet(self, key, title):
+        with self.lock:
+            (self.worksheets.get(key) or {}).pop(title, None)
+        self.save()
+
+    def save(self):
+        with self.lock:
+            data = {"spreadsheets": self.spreadsheets, "worksheets": self.worksheets}
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            # Write to a temporary file first so a crash never leaves half a file
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.path)
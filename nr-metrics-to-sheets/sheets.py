@@ -0,0 +1,358 @@
+import os, re, random, threading
+from dotenv import load_dotenv
+import profiling
+from sheet_ids import SheetIds
+from sheet_blocks import BlockIndex, split_blocks
+import rotation
+
+# Spreadsheet every collector writes to
+WORKBOOK = "Production Reliability Workbook"
+
+# The Sheets client, the workbook and its worksheets are opened on first use
+# and reused for the rest of the run, so collectors running in one process
+# authenticate once and open the workbook once. gspread itself is only
+# imported then, so importing a collector stays cheap.
+# Spreadsheet keys and worksheet gids are kept in sheet_ids/sheet_ids.json between
+# runs (see sheet_ids.py), so a run normally opens the workbook by key with one
+# metadata call and looks nothing else up.
+_client = None
+_spreadsheet = None
+_worksheets = {}
+_ids = None
+_ids_loaded = False
+_index = None
+_index_loaded = False
+_lock = threading.Lock()
+_ids_lock = threading.Lock()
+
+
+# Initialize Google Sheets client using service account credentials
+# Use the path from environment variable or default to service_account.json in current directory
+# In GitHub Actions, this file is created from a base64-encoded secret
+def get_client():
+    global _client
+    with _lock:
+        if _client is None:
+            with profiling.phase("auth"):
+                import gspread
+                # Imported by another script, the credentials path may still be in .env
+                load_dotenv()
+                service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', 'service_account.json')
+                _client = gspread.service_account(filename=service_account_path)
+    return _client
+
+
+# The ID resolver, loaded on first use; None when NR_SHEET_IDS=0
+def get_ids():
+    global _ids, _ids_loaded
+    with _ids_lock:
+        if not _ids_loaded:
+            _ids = SheetIds.from_env()
+            _ids_loaded = True
+    return _ids
+
+
+# The date block index, opened on first use; None when NR_BLOCK_INDEX=0
+def get_index():
+    global _index, _index_loaded
+    with _ids_lock:
+        if not _index_loaded:
+            _index = BlockIndex.from_env()
+            _index_loaded = True
+    return _index
+
+
+def get_spreadsheet():
+    global _spreadsheet
+    client = get_client()
+    with _lock:
+        if _spreadsheet is None:
+            _spreadsheet = open_workbook(client)
+    return _spreadsheet
+
+
+# Open the workbook by its remembered key, searching Drive by title only when
+# there is no key yet or it no longer opens a spreadsheet of that title
+def open_workbook(client):
+    import gspread
+    ids = get_ids()
+    key = ids.spreadsheet(WORKBOOK) if ids else None
+    if key:
+        try:
+            spreadsheet = client.open_by_key(key)
+            if spreadsheet.title == WORKBOOK:
+                return spreadsheet
+        except (gspread.exceptions.SpreadsheetNotFound, PermissionError):
+            pass
+        print(f"Remembered key of {WORKBOOK} is stale, searching Drive for it")
+        ids.forget_spreadsheet(WORKBOOK)
+
+    spreadsheet = client.open(WORKBOOK)
+    if ids:
+        ids.remember_spreadsheet(WORKBOOK, spreadsheet.id)
+    return spreadsheet
+
+
+# Read every worksheet of the workbook with one metadata call and remember them
+# Call with _lock held
+def load_worksheets(spreadsheet):
+    worksheets = spreadsheet.worksheets()
+    _worksheets.clear()
+    _worksheets.update((worksheet.title, worksheet) for worksheet in worksheets)
+    ids = get_ids()
+    if ids:
+        ids.remember_worksheets(spreadsheet.id, {
+            worksheet.title: {
+                "sheetId": worksheet.id,
+                "title": worksheet.title,
+                "index": worksheet.index,
+                "gridProperties": {"rowCount": worksheet.row_count, "columnCount": worksheet.col_count},
+            }
+            for worksheet in worksheets
+        })
+    return worksheets
+
+
+# Worksheet of the workbook by title
+# A remembered worksheet is rebuilt from its stored properties without any API
+# call; its row and column counts may be out of date, so code that needs them
+# calls load_worksheets() first
+def get_worksheet(title):
+    import gspread
+    spreadsheet = get_spreadsheet()
+    ids = get_ids()
+    with _lock:
+        if title not in _worksheets:
+            properties = ids.worksheet(spreadsheet.id, title) if ids else None
+            if properties:
+                _worksheets[title] = gspread.Worksheet(spreadsheet, properties, spreadsheet.id, spreadsheet.client)
+            else:
+                load_worksheets(spreadsheet)
+        if title not in _worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return _worksheets[title]
+
+
+# Forget a worksheet whose remembered properties turned out to be stale
+def forget_worksheet(title):
+    spreadsheet = get_spreadsheet()
+    with _lock:
+        _worksheets.pop(title, None)
+    ids = get_ids()
+    if ids:
+        ids.forget_worksheet(spreadsheet.id, title)
+
+
+# First and last row of an A1 range such as 'Tab'!A10:G20
+RANGE_ROWS = re.compile(r"![A-Z]*(\d+)(?::[A-Z]*(\d+))?$")
+
+
+# Positions of the date blocks in rows written from first_row on,
+# as (period, first_row, last_row)
+def block_positions(rows, first_row):
+    positions = []
+    for period, block_rows in split_blocks(rows):
+        if period is not None:
+            positions.append((period, first_row, first_row + len(block_rows) - 1))
+        first_row += len(block_rows)
+    return positions
+
+
+# Append rows below the data of a worksheet
+# Rows holding a date block that is already in the sheet go through
+# append_to_worksheets instead, which overwrites the block in place, and so do
+# all rows while worksheets are rotated (see rotation.py)
+# If the tab was renamed or deleted since it was remembered, Sheets rejects the
+# range; the worksheet is then looked up again and the append retried once
+def append_rows(title, rows):
+    import gspread
+    spreadsheet = get_spreadsheet()
+    index = get_index()
+    if rotation.enabled() or index and any(
+        period is not None and index.find(spreadsheet.id, title, period)
+        for period, _ in split_blocks(rows)
+    ):
+        append_to_worksheets({title: rows})
+        return
+
+    try:
+        response = get_worksheet(title).append_rows(rows, value_input_option="USER_ENTERED")
+    except gspread.exceptions.APIError as e:
+        if e.code != 400:
+            raise
+        forget_worksheet(title)
+        response = get_worksheet(title).append_rows(rows, value_input_option="USER_ENTERED")
+
+    written = RANGE_ROWS.search(((response or {}).get("updates") or {}).get("updatedRange", ""))
+    if index and written:
+        index.record(spreadsheet.id, title, block_positions(rows, int(written.group(1))))
+
+
+# Plan the write of rows to one worksheet whose column A holds `column`
+# A date block found in the index, whose separator is still on its first row,
+# is written over its old rows; if it got longer, rows are inserted at its end
+# first, and if it got shorter its last rows are deleted, so the blocks below
+# move with it. Everything else goes below the data. Returns the writes as
+# (period, first_row, last_row, rows), in rows after the resizes, and the
+# resizes as (last_row, count), count < 0 for deleted rows, in rows before them.
+def plan_writes(spreadsheet_id, title, rows, column, index):
+    known, new = [], []
+    for period, block_rows in split_blocks(rows):
+        found = index.find(spreadsheet_id, title, period) if index and period is not None else None
+        if found:
+            first, last = found
+            if first <= len(column) and column[first - 1] == period:
+                known.append((first, last, period, block_rows))
+                continue
+            print(f"Warning: block {period} of {title} is no longer where it was written, appending it again")
+            index.forget(spreadsheet_id, title, period)
+        new.append((period, block_rows))
+
+    writes, resizes, grown = [], [], 0
+    for first, last, period, block_rows in sorted(known, key=lambda block: block[0]):
+        change = len(block_rows) - (last - first + 1)
+        if change:
+            resizes.append((last, change))
+        writes.append((period, first + grown, first + grown + len(block_rows) - 1, block_rows))
+        grown += change
+
+    next_row = len(column) + grown + 1
+    for period, block_rows in new:
+        writes.append((period, next_row, next_row + len(block_rows) - 1, block_rows))
+        next_row += len(block_rows)
+    return writes, resizes
+
+
+# Requests that start shard `title` of worksheet `base`: the tab is added and
+# gets the header rows of the original tab, formatting included
+# Returns the requests, the new worksheet and its number of header rows
+def start_shard(spreadsheet, base, title, rows, sheet_ids):
+    import gspread
+    header_rows = base.frozen_row_count or 1
+    sheet_id = random.randrange(1, 2 ** 31 - 1)
+    while sheet_id in sheet_ids:
+        sheet_id = random.randrange(1, 2 ** 31 - 1)
+    sheet_ids.add(sheet_id)
+
+    grid = {"rowCount": header_rows + rows, "columnCount": base.col_count, "frozenRowCount": base.frozen_row_count}
+    requests = [
+        {"addSheet": {"properties": {"sheetId": sheet_id, "title": title, "gridProperties": grid}}},
+        {"copyPaste": {
+            "source": {"sheetId": base.id, "startRowIndex": 0, "endRowIndex": header_rows,
+                       "startColumnIndex": 0, "endColumnIndex": base.col_count},
+            "destination": {"sheetId": sheet_id, "startRowIndex": 0, "endRowIndex": header_rows,
+                            "startColumnIndex": 0, "endColumnIndex": base.col_count},
+            "pasteType": "PASTE_NORMAL",
+        }},
+    ]
+    properties = {"sheetId": sheet_id, "title": title, "index": len(sheet_ids) - 1, "gridProperties": grid}
+    return requests, gspread.Worksheet(spreadsheet, properties, spreadsheet.id, spreadsheet.client), header_rows
+
+
+# Write rows to several worksheets of the workbook at once, e.g.
+# {"Monthly APM Metrics": rows, "Monthly 5XX Errors": rows}
+# New date blocks are appended below the data and blocks already written are
+# overwritten in place (see plan_writes). While worksheets are rotated, each
+# worksheet's rows go to its current shard, and a shard that is missing or
+# would grow past the limits is started (see rotation.py). However many
+# worksheets there are this takes the same few API calls: one metadata read for
+# the tabs, one read of column A of every tab, one structural update if shards
+# must be started, rows inserted or deleted or a tab is too short, and one
+# values.batchUpdate.
+# Every report row starts with a value in column A, so its last filled cell
+# marks the end of the data.
+def append_to_worksheets(pending):
+    import gspread
+    from gspread.utils import absolute_range_name, rowcol_to_a1
+
+    pending = {title: rows for title, rows in pending.items() if rows}
+    if not pending:
+        return
+    spreadsheet = get_spreadsheet()
+    index = get_index()
+    with _lock:
+        worksheets = {worksheet.title: worksheet for worksheet in load_worksheets(spreadsheet)}
+    for title in pending:
+        if title not in worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    # Tab each worksheet's rows go to, and whether it must stay that tab
+    targets = {title: (title, True) for title in pending}
+    if rotation.enabled():
+        label = rotation.period_label()
+        for title, rows in pending.items():
+            periods = [period for period, _ in split_blocks(rows) if period is not None]
+
+            def holds_block(tab):
+                return bool(index) and any(index.find(spreadsheet.id, tab, period) for period in periods)
+
+            targets[title] = rotation.choose_shard(title, worksheets, holds_block, label)
+
+    existing = [tab for tab, _ in targets.values() if tab in worksheets]
+    columns = spreadsheet.values_batch_get(
+        [absolute_range_name(tab, "A:A") for tab in existing], params={"majorDimension": "COLUMNS"},
+    )
+    column_of = {
+        tab: (value_range.get("values") or [[]])[0]
+        for tab, value_range in zip(existing, columns.get("valueRanges", []))
+    }
+
+    data, structure, plans, started = [], [], {}, {}
+    sheet_ids = {worksheet.id for worksheet in worksheets.values()}
+    for title, rows in pending.items():
+        tab, pinned = targets[title]
+        if tab not in worksheets or not pinned and rotation.too_full(
+            len(column_of[tab]), worksheets[tab].col_count, len(rows)
+        ):
+            if tab in worksheets:
+                tab = rotation.next_shard(title, worksheets, rotation.period_label())
+            requests, worksheets[tab], header_rows = start_shard(spreadsheet, worksheets[title], tab, len(rows), sheet_ids)
+            structure.extend(requests)
+            started[tab] = worksheets[tab]
+            column_of[tab] = [""] * header_rows
+
+        worksheet = worksheets[tab]
+        writes, resizes = plan_writes(spreadsheet.id, tab, rows, column_of[tab], index)
+        plans[tab] = (writes, resizes)
+
+        # Resized from the bottom up, so the rows of each resize are still where they were
+        for last_row, count in sorted(resizes, reverse=True):
+            if count > 0:
+                structure.append({"insertDimension": {
+                    "range": {"sheetId": worksheet.id, "dimension": "ROWS", "startIndex": last_row, "endIndex": last_row + count},
+                    "inheritFromBefore": True,
+                }})
+            else:
+                structure.append({"deleteDimension": {
+                    "range": {"sheetId": worksheet.id, "dimension": "ROWS", "startIndex": last_row + count, "endIndex": last_row},
+                }})
+
+        width = max(len(row) for row in rows)
+        for _, first, last, block_rows in writes:
+            data.append({"range": absolute_range_name(tab, f"A{first}:{rowcol_to_a1(last, width)}"), "values": block_rows})
+
+        end = max(last for _, _, last, _ in writes)
+        row_count = worksheet.row_count + sum(count for _, count in resizes)
+        if end > row_count:
+            structure.append({"appendDimension": {"sheetId": worksheet.id, "dimension": "ROWS", "length": end - row_count}})
+        if width > worksheet.col_count:
+            structure.append({"appendDimension": {"sheetId": worksheet.id, "dimension": "COLUMNS", "length": width - worksheet.col_count}})
+
+    if structure:
+        spreadsheet.batch_update({"requests": structure})
+        if started:
+            print(f"Started worksheets: {', '.join(started)}")
+            with _lock:
+                _worksheets.update(started)
+        # The index follows the moved rows right away, even if the write fails
+        if index:
+            for tab, (_, resizes) in plans.items():
+                for last_row, count in sorted(resizes, reverse=True):
+                    index.shift(spreadsheet.id, tab, last_row, count)
+    spreadsheet.values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+
+    if index:
+        for tab, (writes, _) in plans.items():
+            index.record(spreadsheet.id, tab, [
+                (period, first, last) for period, first, last, _ in writes if period is not None
+            ])
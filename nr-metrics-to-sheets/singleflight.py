@@ -0,0 +1,53 @@
+import threading
+from concurrent.futures import Future
+
+
+# Shares the result of identical work within one run
+# The first caller for a key does the work; callers arriving while it is in
+# flight wait for that result, and callers arriving afterwards get it straight
+# away. Failures are not remembered, so a later caller tries again.
+# Results are shared between callers and must not be modified.
+class SingleFlight:
+    def __init__(self):
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Return (future, owner); the owner must resolve() or fail() the future
+    def claim(self, key):
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                self.hits += 1
+                return future, False
+            future = Future()
+            self.futures[key] = future
+            self.misses += 1
+            return future, True
+
+    def resolve(self, future, result):
+        future.set_result(result)
+
+    # Forget a failed key so the next caller runs the work again
+    def fail(self, key, future, error):
+        with self.lock:
+            if self.futures.get(key) is future:
+                del self.futures[key]
+        future.set_exception(error)
+
+    # Run fn(*args) once per key and return its result
+    def do(self, key, fn, *args):
+        future, owner = self.claim(key)
+        if not owner:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self.fail(key, future, e)
+            raise
+        self.resolve(future, result)
+        return result
+
+    def summary(self):
+        return f"{self.hits + self.misses} queries, {self.misses} sent or read from cache, {self.hits} shared"
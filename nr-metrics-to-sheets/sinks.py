@@ -0,0 +1,243 @@
+import os, re, csv, json, datetime, threading, contextlib
+import sheets
+import profiling
+from outbox import get_outbox
+
+# Where the report rows go, e.g. "sheets", "jsonl" or "sheets,csv"
+SINKS = os.getenv("NR_SINKS", "sheets")
+
+# Directory the local file sinks write into
+OUTPUT_DIR = os.getenv("NR_OUTPUT_DIR", "output")
+
+
+# File name for a worksheet title, e.g. "Weekly 5XX Errors" -> "weekly_5xx_errors"
+def slugify(title):
+    return re.sub(r"[^a-z0-9]+", "_", title.lower()).strip("_")
+
+
+# Appends rows to the Google Sheets worksheet of the same title
+# Between start_batch() and flush() the rows are held back and then written to
+# all worksheets together (see sheets.append_to_worksheets), so a run makes the
+# same few Sheets calls however many collectors it runs
+# Every write goes to the outbox first (see outbox.py); if Sheets fails, the
+# rows stay there for `python outbox.py flush`
+class SheetsSink:
+    def __init__(self, outbox=None):
+        self.outbox = outbox if outbox is not None else get_outbox()
+        self.lock = threading.Lock()
+        self.pending = None
+
+    def append_rows(self, worksheet, rows):
+        write_id = None
+        if self.outbox is not None:
+            stored = self.outbox.add(worksheet, rows)
+            if stored is None:
+                print(f"Skipping {worksheet}: this run already wrote these rows")
+                return
+            write_id, rows = stored
+
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((write_id, worksheet, rows))
+                return
+        try:
+            sheets.append_rows(worksheet, rows)
+        except Exception:
+            self.kept_in_outbox()
+            raise
+        self.mark_sent([write_id])
+
+    def start_batch(self):
+        with self.lock:
+            if self.pending is None:
+                self.pending = []
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if not pending:
+            return
+        rows_by_worksheet = {}
+        for _, worksheet, rows in pending:
+            rows_by_worksheet.setdefault(worksheet, []).extend(rows)
+        try:
+            sheets.append_to_worksheets(rows_by_worksheet)
+        except Exception:
+            self.kept_in_outbox()
+            raise
+        self.mark_sent([write_id for write_id, _, _ in pending])
+
+    def mark_sent(self, ids):
+        if self.outbox is not None:
+            self.outbox.mark_sent([write_id for write_id in ids if write_id is not None])
+
+    def kept_in_outbox(self):
+        if self.outbox is not None:
+            print(f"Rows kept in {self.outbox.path}; resend them with: python outbox.py flush --run-id {self.outbox.run_id}")
+
+
+# Appends one JSON object per row to <worksheet>.jsonl
+class JsonlSink:
+    def __init__(self, directory=None):
+        self.directory = directory or OUTPUT_DIR
+        self.lock = threading.Lock()
+
+    def append_rows(self, worksheet, rows):
+        written_at = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, f"{slugify(worksheet)}.jsonl"), "a") as f:
+                for row in rows:
+                    f.write(json.dumps({"worksheet": worksheet, "writtenAt": written_at, "row": row}) + "\n")
+
+
+# Appends rows to <worksheet>.csv, as they would appear in the sheet
+class CsvSink:
+    def __init__(self, directory=None):
+        self.directory = directory or OUTPUT_DIR
+        self.lock = threading.Lock()
+
+    def append_rows(self, worksheet, rows):
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, f"{slugify(worksheet)}.csv"), "a", newline="") as f:
+                csv.writer(f).writerows(rows)
+
+
+# Writes each append as a new part file under <worksheet>/, so the directory
+# reads as one Parquet dataset. A worksheet column mixes date separator labels
+# and numbers, so values are stored as text (None stays null).
+# Needs pyarrow, which is not in requirements.txt.
+class ParquetSink:
+    def __init__(self, directory=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("The parquet sink needs pyarrow: pip install pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.directory = directory or OUTPUT_DIR
+        self.lock = threading.Lock()
+        self.parts = 0
+
+    def append_rows(self, worksheet, rows):
+        if not rows:
+            return
+        width = max(len(row) for row in rows)
+        columns = {
+            f"c{i}": [None if i >= len(row) or row[i] is None else str(row[i]) for row in rows]
+            for i in range(width)
+        }
+        table = self.pa.table({name: self.pa.array(values, self.pa.string()) for name, values in columns.items()})
+
+        with self.lock:
+            self.parts += 1
+            part = f"{datetime.datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}-{self.parts}.parquet"
+        directory = os.path.join(self.directory, slugify(worksheet))
+        os.makedirs(directory, exist_ok=True)
+        self.pq.write_table(table, os.path.join(directory, part))
+
+
+# Writes every append to several sinks
+# A failing sink does not keep the rows from the others; the first error is
+# raised once all of them were tried
+class FanOutSink:
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def append_rows(self, worksheet, rows):
+        error = None
+        for sink in self.sinks:
+            try:
+                sink.append_rows(worksheet, rows)
+            except Exception as e:
+                print(f"Warning: writing {worksheet} to {type(sink).__name__} failed: {e}")
+                error = error or e
+        if error is not None:
+            raise error
+
+    def start_batch(self):
+        for sink in self.sinks:
+            start_batch(sink)
+
+    def flush(self):
+        error = None
+        for sink in self.sinks:
+            try:
+                flush(sink)
+            except Exception as e:
+                print(f"Warning: flushing {type(sink).__name__} failed: {e}")
+                error = error or e
+        if error is not None:
+            raise error
+
+
+SINK_TYPES = {
+    "sheets": SheetsSink,
+    "jsonl": JsonlSink,
+    "csv": CsvSink,
+    "parquet": ParquetSink,
+}
+
+
+# Build the sink for a comma-separated list of sink names
+def build_sink(names):
+    names = [name.strip() for name in names.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SINK_TYPES]
+    if unknown or not names:
+        raise ValueError(f"unknown sinks: {', '.join(unknown) or '(none)'} (choose from {', '.join(SINK_TYPES)})")
+    sinks = [SINK_TYPES[name]() for name in names]
+    return sinks[0] if len(sinks) == 1 else FanOutSink(sinks)
+
+
+# The sink is built on first use from NR_SINKS and shared by all collectors
+_sink = None
+_sink_lock = threading.Lock()
+
+def get_sink():
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = build_sink(SINKS)
+    return _sink
+
+
+# Replace the shared sink with an already built one (e.g. a fake in benchmarks)
+def use(sink):
+    global _sink
+    with _sink_lock:
+        _sink = sink
+
+
+# Replace the shared sink by name, e.g. from a command-line option
+def configure(names):
+    use(build_sink(names))
+
+
+# Append report rows to a worksheet through the shared sink
+def append_rows(worksheet, rows):
+    with profiling.phase("write"):
+        get_sink().append_rows(worksheet, rows)
+
+
+# Sinks that can hold rows back implement start_batch() and flush()
+def start_batch(sink):
+    if hasattr(sink, "start_batch"):
+        sink.start_batch()
+
+
+def flush(sink):
+    if hasattr(sink, "flush"):
+        sink.flush()
+
+
+# Hold back the Sheets writes made inside the block and send them together
+# when it ends; if the block raises, the held rows are not written
+@contextlib.contextmanager
+def batch():
+    sink = get_sink()
+    start_batch(sink)
+    yield sink
+    with profiling.phase("write"):
+        flush(sink)
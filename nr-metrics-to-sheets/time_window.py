@@ -0,0 +1,110 @@
+import os, re, datetime, calendar
+
+# "now" is rounded down to this many seconds, so queries built a few
+# seconds apart in the same run resolve to exactly the same window
+WINDOW_ALIGN_SECONDS = int(os.getenv("NR_WINDOW_ALIGN_SECONDS", "60"))
+
+# Directory where the anchor of each run ID is remembered
+ANCHOR_DIR = os.path.join(os.getenv("NR_CACHE_DIR", ".nrql_cache"), "anchors")
+
+# Relative NRQL time clauses, e.g. SINCE 1 day ago / UNTIL now
+RELATIVE_SINCE = re.compile(r"\bSINCE\s+(\d+)\s+(minute|hour|day|week|month)s?\s+ago\b", re.IGNORECASE)
+UNTIL_NOW = re.compile(r"\bUNTIL\s+now\b", re.IGNORECASE)
+
+
+# Parse NR_RUN_ANCHOR, given as epoch seconds or an ISO timestamp
+def parse_anchor(value):
+    try:
+        return datetime.datetime.fromtimestamp(float(value), datetime.timezone.utc)
+    except ValueError:
+        anchor = datetime.datetime.fromisoformat(value)
+        if anchor.tzinfo is None:
+            anchor = anchor.replace(tzinfo=datetime.timezone.utc)
+        return anchor
+
+
+# Round a datetime down to WINDOW_ALIGN_SECONDS
+def align(moment):
+    epoch = int(moment.timestamp())
+    return datetime.datetime.fromtimestamp(epoch - epoch % WINDOW_ALIGN_SECONDS, datetime.timezone.utc)
+
+
+# Load or remember the anchor of a run ID, so a re-run of the same workflow
+# run resolves "now" to the same instant as the first attempt
+def anchor_for_run(run_id, moment):
+    path = os.path.join(ANCHOR_DIR, f"{run_id}.txt")
+    if os.path.exists(path):
+        with open(path) as f:
+            return parse_anchor(f.read().strip())
+    os.makedirs(ANCHOR_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        f.write(str(int(moment.timestamp())))
+    return moment
+
+
+# The instant every relative window in this run is resolved against
+# NR_RUN_ANCHOR pins it explicitly, NR_RUN_ID reuses the first attempt's anchor
+_anchor = None
+
+def get_run_anchor():
+    global _anchor
+    if _anchor is None:
+        if os.getenv("NR_RUN_ANCHOR"):
+            _anchor = parse_anchor(os.getenv("NR_RUN_ANCHOR"))
+        elif os.getenv("NR_RUN_ID"):
+            _anchor = anchor_for_run(os.getenv("NR_RUN_ID"), align(datetime.datetime.now(datetime.timezone.utc)))
+        else:
+            _anchor = align(datetime.datetime.now(datetime.timezone.utc))
+    return _anchor
+
+
+# Same day and time `months` calendar months earlier, clamped to the month's length
+def subtract_months(moment, months):
+    month_index = moment.year * 12 + moment.month - 1 - months
+    year, month = divmod(month_index, 12)
+    day = min(moment.day, calendar.monthrange(year, month + 1)[1])
+    return moment.replace(year=year, month=month + 1, day=day)
+
+
+# Start of a relative window such as "1 day ago" measured back from `anchor`
+def window_start(anchor, amount, unit):
+    unit = unit.lower()
+    if unit == "month":
+        return subtract_months(anchor, amount)
+    if unit == "week":
+        return anchor - datetime.timedelta(weeks=amount)
+    return anchor - datetime.timedelta(**{f"{unit}s": amount})
+
+
+# Epoch milliseconds, the absolute time format NRQL accepts in SINCE/UNTIL
+def to_epoch_ms(moment):
+    return int(moment.timestamp() * 1000)
+
+
+# Rewrite relative SINCE/UNTIL clauses into absolute epoch milliseconds
+# Queries that are already absolute come back unchanged
+def resolve_window(nrql, anchor=None):
+    if not (RELATIVE_SINCE.search(nrql) or UNTIL_NOW.search(nrql)):
+        return nrql
+    anchor = anchor or get_run_anchor()
+    nrql = RELATIVE_SINCE.sub(
+        lambda m: f"SINCE {to_epoch_ms(window_start(anchor, int(m.group(1)), m.group(2)))}", nrql)
+
+    # Without UNTIL the window would end at the server's "now", so pin it
+    if not UNTIL_NOW.search(nrql) and not re.search(r"\bUNTIL\b", nrql, re.IGNORECASE):
+        return f"{nrql.rstrip()} UNTIL {to_epoch_ms(anchor)}"
+    return UNTIL_NOW.sub(f"UNTIL {to_epoch_ms(anchor)}", nrql)
+
+
+# Absolute (since_ms, until_ms) of "SINCE <amount> <unit> ago UNTIL now" for this run
+def relative_window(amount, unit, anchor=None):
+    anchor = anchor or get_run_anchor()
+    return to_epoch_ms(window_start(anchor, amount, unit)), to_epoch_ms(anchor)
+
+
+# Absolute (since_ms, until_ms) of "<amount> <unit>" of whole UTC days, ending
+# at the UTC midnight at or before the run anchor
+def day_aligned_window(amount, unit, anchor=None):
+    anchor = anchor or get_run_anchor()
+    end = anchor.astimezone(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return to_epoch_ms(window_start(end, amount, unit)), to_epoch_ms(end)